@@ -16,7 +16,6 @@
 
 import atexit
 import math
-import time
 import random
 
 from pydish import connector
@@ -184,7 +183,8 @@ def rotation_from_degrees(deg):
 color = [random.randint(8,255)/255.0, random.randint(8,255)/255.0, random.randint(8,255)/255.0]
 deg = 0
 while True:
-    time.sleep(0.01)
+    # Wait for the display to be ready for the next frame, rather than sleeping
+    d.next_frame()
     d.clear()
     draw_f(d, width, height, program_id, vertex_buffer, 200, 200, rotation_from_degrees(deg), [abs(rotation_from_degrees(deg)[0])]*2, color)
     d.update_canvas()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Mathew Young
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import random
+import struct
+
+from pydish import connector
+
+connector.run()
+
+def on_close():
+    connector.shutdown()
+atexit.register(on_close)
+
+d = connector.Display()
+d.init_display()
+
+width, height = d.get_resolution()
+print("Width: %d Height: %d" % (width, height))
+vertex_shader_id = d.compile_vertex_shader("""
+#version 300 es
+
+precision mediump float;
+
+// The corners of a unit square, shared by every rectangle
+in vec2 a_position;
+
+// Per instance attributes, one entry for each rectangle
+in vec2 a_offset;
+in vec2 a_size;
+in vec3 a_color;
+
+uniform vec2 u_resolution;
+
+out vec4 v_color;
+
+void main() {
+  vec2 position = a_offset + a_position * a_size;
+  vec2 clipSpace = (position / u_resolution) * 2.0 - 1.0;
+
+  gl_Position = vec4(clipSpace * vec2(1, -1), 0, 1);
+  v_color = vec4(a_color, 1.0);
+}
+""".lstrip())
+
+fragment_shader_id = d.compile_fragment_shader("""
+#version 300 es
+
+precision mediump float;
+
+in vec4 v_color;
+
+out vec4 outColor;
+
+void main() {
+  outColor = v_color;
+}
+""".lstrip())
+
+program_id = d.create_program(vertex_shader_id, fragment_shader_id,
+uniforms={
+    "u_resolution": {"size": 2},
+},
+attributes={
+    "a_position": {"size": 2, "type": "uint8"},
+    "a_offset": {"size": 2, "divisor": 1, "type": "int16"},
+    "a_size": {"size": 2, "divisor": 1, "type": "int16"},
+    "a_color": {"size": 3, "divisor": 1, "type": "uint8", "normalized": True},
+})
+
+# The per instance attributes are interleaved in a single buffer, 12 bytes
+# for each rectangle: offset (2 x int16), size (2 x int16), color (3 x uint8
+# and a byte of padding)
+vertex_buffer = d.create_buffer()
+instance_buffer = d.create_buffer()
+d.program_link_attributes(program_id, {
+    "a_position": vertex_buffer,
+    "a_offset": {"buffer": instance_buffer, "stride": 12, "offset": 0},
+    "a_size": {"buffer": instance_buffer, "stride": 12, "offset": 4},
+    "a_color": {"buffer": instance_buffer, "stride": 12, "offset": 8}
+})
+
+# Initialise the display context properties
+d.set_gl_viewport(0, 0, width, height)
+d.set_gl_clear_color(0, 0, 0, 0)
+
+# Initial Clear of display context
+d.clear()
+
+count = 100
+instances = bytearray()
+for i in range(count):
+    instances += struct.pack('<hhhhBBBx',
+        random.randint(0,400), random.randint(0,400), # (x, y)
+        random.randint(0,50), random.randint(0,50), # (width, height)
+        random.randint(50,255), random.randint(50,255), random.randint(50,255)) # (r,g,b)
+
+# All of the rectangles are drawn with a single call
+d.program_update_uniforms(program_id, {
+    "u_resolution": [width, height],
+})
+d.buffer_update_data(vertex_buffer, [
+    0,0,
+    1,0,
+    0,1,
+    0,1,
+    1,0,
+    1,1
+], dtype="uint8")
+d.buffer_update_data(instance_buffer, instances)
+d.execute_program(program_id, "triangles", instances=count)
+d.update_canvas()
+
+print("Press ENTER to exit")
+input()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Mathew Young
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import time
+import trio
+
+from contextlib import asynccontextmanager
+from functools import partial
+
+from . import http_server
+from .connector import BaseDisplay, Bundle, PendingCall, serve_connector, DEFAULT_SESSION
+from .metrics import Metrics
+
+class AsyncPendingCall(PendingCall):
+    def __init__(self, display, request_id, result=None):
+        super().__init__(display, request_id, result)
+        self.event = trio.Event()
+
+    def result(self):
+        if self.response is None:
+            raise RuntimeError("the call hasn't finished yet, await it first")
+        return super().result()
+
+    async def wait_done(self):
+        if self.response is None:
+            await self.event.wait()
+
+    async def wait(self):
+        await self.wait_done()
+        return self.result()
+
+    def __await__(self):
+        return self.wait().__await__()
+
+class AsyncDisplay(BaseDisplay):
+    # Talks to the device from inside the caller's trio event loop, commands
+    # go straight into the connector's memory channel instead of through a
+    # separate process. Every api method returns an awaitable.
+    _pending_class = AsyncPendingCall
+
+    def __init__(self, session=DEFAULT_SESSION):
+        super().__init__(session)
+        self._send_channel, self._command_channel = trio.open_memory_channel(math.inf)
+        self._reply_send_channel, self._reply_channel = trio.open_memory_channel(math.inf)
+        self.input_send_channel, self.input_channel = trio.open_memory_channel(math.inf)
+        self._connected_event = trio.Event()
+
+    def _send(self, msg):
+        self._send_channel.send_nowait(msg)
+
+    async def _next_command(self):
+        return await self._command_channel.receive()
+
+    def _dispatch(self, r):
+        pending = self._pending.get(r.get('id'))
+        super()._dispatch(r)
+        if pending is not None:
+            pending.event.set()
+        if self._connected:
+            self._connected_event.set()
+        elif self._connected_event.is_set():
+            self._connected_event = trio.Event()
+
+    async def wait_connected(self, timeout=None):
+        # Returns once a device is attached to the session, raises
+        # TimeoutError if none attaches within timeout seconds
+        with trio.move_on_after(math.inf if timeout is None else timeout):
+            await self._connected_event.wait()
+            return
+        raise TimeoutError("no device connected to session %s" % self.session)
+
+    async def _dispatch_replies(self):
+        async for r in self._reply_channel:
+            self._dispatch(r)
+
+    async def _finish(self, pending):
+        await pending.wait_done()
+        self._raise_errors()
+        return pending.result()
+
+    def _call(self, func, args=None, kwargs=None, result=None, wait=True, api="display"):
+        # Fire and forget calls return their (awaitable) AsyncPendingCall
+        # straight away, the command is already on its way
+        pending = self._prepare(func, args, kwargs, result, api)
+        if pending is None:
+            # Recorded into a batch, there's nothing to wait for
+            pending = self._completed(func)
+        if not wait:
+            return pending
+        return self._finish(pending)
+
+    def submit(self, wait=True):
+        # An empty batch isn't sent, but there's still something to await
+        if not self._batch:
+            self._end_batch()
+            pending = self._completed("batch", lambda data: [])
+            return self._finish(pending) if wait else pending
+        return super().submit(wait)
+
+    async def flush(self):
+        if self._pending:
+            await self._pending[max(self._pending)].wait_done()
+        self._raise_errors()
+
+    @asynccontextmanager
+    async def batch(self):
+        self.begin_batch()
+        try:
+            yield self
+        except BaseException:
+            self._discard_batch()
+            raise
+        await self.submit()
+
+    @asynccontextmanager
+    async def frame(self):
+        async with self.batch():
+            yield self
+            await self.update_canvas()
+
+    @asynccontextmanager
+    async def record_bundle(self):
+        bundle = Bundle()
+        self.begin_batch()
+        self._bypass_caches = True
+        try:
+            yield bundle
+        except BaseException:
+            self._discard_batch()
+            raise
+        await self._store_bundle(bundle, self._end_batch())
+
+@asynccontextmanager
+async def open_display(host='0.0.0.0', http_port=8080, ws_port=8088, session=DEFAULT_SESSION):
+    display = AsyncDisplay(session)
+    metrics = Metrics()
+    async with trio.open_nursery() as n:
+        n.start_soon(display._dispatch_replies)
+        await n.start(partial(http_server.http_main, host=host, port=http_port, ws_port=ws_port, metrics=metrics))
+        await n.start(serve_connector, display._next_command,
+            display._reply_send_channel.send_nowait, display.input_send_channel.send_nowait,
+            host, ws_port, metrics)
+        display._startup_times["connector_ready"] = time.perf_counter()
+        yield display
+        n.cancel_scope.cancel()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Mathew Young
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import math
+import random
+import time
+import trio
+
+from array import array
+from multiprocessing import Process
+
+from . import connector
+from .fake_device import run_fake_device
+
+def percentiles(samples):
+    # In milliseconds, nearest rank
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    def rank(p):
+        return samples[min(len(samples) - 1, max(0, int(math.ceil(p / 100.0 * len(samples))) - 1))] * 1000.0
+    return {"p50": rank(50), "p90": rank(90), "p99": rank(99), "max": samples[-1] * 1000.0}
+
+def _timed(display, count, step):
+    # Runs step count times and returns the total time and each step's time
+    latencies = []
+    started = time.perf_counter()
+    for i in range(count):
+        t = time.perf_counter()
+        step(i)
+        latencies.append(time.perf_counter() - t)
+    display.flush()
+    return time.perf_counter() - started, latencies
+
+def _result(name, params, display, uploaded, ops, elapsed, latencies, unit):
+    return {
+        "name": name,
+        "params": params,
+        "ops": ops,
+        "unit": unit,
+        "rate": ops / elapsed,
+        "bytes_per_sec": (display.upload_stats['uploaded_bytes'] - uploaded) / elapsed,
+        "latency_ms": percentiles(latencies)
+    }
+
+def bench_void_calls(display, scene, count):
+    uploaded = display.upload_stats['uploaded_bytes']
+    elapsed, latencies = _timed(display, count, lambda i: display.set_gl_clear_color(0, 0, i % 2, 1))
+    return _result("void_calls", {}, display, uploaded, count, elapsed, latencies, "calls")
+
+def bench_sync_calls(display, scene, count):
+    uploaded = display.upload_stats['uploaded_bytes']
+    elapsed, latencies = _timed(display, count, lambda i: display.get_resolution())
+    return _result("sync_calls", {}, display, uploaded, count, elapsed, latencies, "calls")
+
+def bench_uploads(display, scene, count, floats):
+    uploaded = display.upload_stats['uploaded_bytes']
+    data = array('f', [random.random() for i in range(floats)])
+    def step(i):
+        # A different value each time, so the upload isn't skipped as a duplicate
+        data[0] = i
+        display.buffer_update_data(scene['buffer'], data)
+    elapsed, latencies = _timed(display, count, step)
+    return _result("uploads", {"floats": floats}, display, uploaded, count, elapsed, latencies, "uploads")
+
+def _draw_rectangle(display, scene, x, y, width, height, color):
+    # As example_rectangles.py draws each rectangle
+    display.program_update_uniforms(scene['program'], {
+        "u_resolution": [scene['width'], scene['height']],
+        "u_color": [*color, 1],
+        "u_translation": [0, 0],
+        "u_rotation": [0, 1],
+        "u_scale": [1, 1],
+    })
+    display.buffer_update_data(scene['buffer'], [
+        x, y,
+        x + width, y,
+        x, y + height,
+        x, y + height,
+        x + width, y,
+        x + width, y + height
+    ])
+    display.execute_program(scene['program'], "triangles")
+
+def bench_rectangles(display, scene, count, rectangles):
+    uploaded = display.upload_stats['uploaded_bytes']
+    def step(i):
+        with display.frame():
+            display.clear()
+            for r in range(rectangles):
+                _draw_rectangle(display, scene,
+                    random.randint(0, 400), random.randint(0, 400),
+                    random.randint(0, 50), random.randint(0, 50),
+                    (random.random(), random.random(), random.random()))
+    elapsed, latencies = _timed(display, count, step)
+    return _result("rectangles", {"rectangles": rectangles}, display, uploaded, count, elapsed, latencies, "frames")
+
+F_VERTICES = [
+    0.0, 0.0, 30.0, 0.0, 0.0, 150.0, 0.0, 150.0, 30.0, 0.0, 30.0, 150.0,
+    30.0, 0.0, 100.0, 0.0, 30.0, 30.0, 30.0, 30.0, 100.0, 0.0, 100.0, 30.0,
+    30.0, 60.0, 67.0, 60.0, 30.0, 90.0, 30.0, 90.0, 67.0, 60.0, 67.0, 90.0
+]
+
+def bench_animated_f(display, scene, count):
+    # As example_animated_F.py's loop, paced by next_frame
+    uploaded = display.upload_stats['uploaded_bytes']
+    def step(i):
+        rad = math.radians(i % 360)
+        display.next_frame()
+        display.clear()
+        display.program_update_uniforms(scene['program'], {
+            "u_resolution": [scene['width'], scene['height']],
+            "u_color": [0.5, 0.2, 0.8, 1],
+            "u_translation": [200, 200],
+            "u_rotation": [math.sin(rad), math.cos(rad)],
+            "u_scale": [abs(math.sin(rad))] * 2,
+        })
+        display.buffer_update_data(scene['buffer'], F_VERTICES)
+        display.execute_program(scene['program'], "triangles")
+        display.update_canvas()
+    elapsed, latencies = _timed(display, count, step)
+    return _result("animated_f", {}, display, uploaded, count, elapsed, latencies, "frames")
+
+def bench_draws(display, scene, count, draws):
+    uploaded = display.upload_stats['uploaded_bytes']
+    def step(i):
+        with display.frame():
+            display.clear()
+            for d in range(draws):
+                display.execute_program(scene['program'], "triangles")
+    elapsed, latencies = _timed(display, count, step)
+    return _result("draws", {"draws": draws}, display, uploaded, count, elapsed, latencies, "frames")
+
+def workloads(scale=1.0):
+    # (function, repetitions, extra arguments), scale shortens or lengthens every run
+    def n(count):
+        return max(1, int(count * scale))
+    return [
+        (bench_void_calls, n(20000), {}),
+        (bench_sync_calls, n(2000), {}),
+        (bench_uploads, n(2000), {"floats": 256}),
+        (bench_uploads, n(500), {"floats": 16384}),
+        (bench_uploads, n(50), {"floats": 262144}),
+        (bench_rectangles, n(200), {"rectangles": 100}),
+        (bench_animated_f, n(300), {}),
+        (bench_draws, n(500), {"draws": 1}),
+        (bench_draws, n(200), {"draws": 100}),
+        (bench_draws, n(20), {"draws": 10000}),
+    ]
+
+def setup_scene(display):
+    display.init_display()
+    width, height = display.get_resolution()
+    vertex_shader = display.compile_vertex_shader("#version 300 es\nin vec2 a_position;\nvoid main() {}\n")
+    fragment_shader = display.compile_fragment_shader("#version 300 es\nvoid main() {}\n")
+    program = display.create_program(vertex_shader, fragment_shader,
+        uniforms={name: {"size": size} for name, size in (
+            ("u_resolution", 2), ("u_color", 4), ("u_translation", 2), ("u_rotation", 2), ("u_scale", 2))},
+        attributes={"a_position": {"size": 2}})
+    buffer = display.create_buffer()
+    display.program_link_attributes(program, {"a_position": buffer})
+    display.buffer_update_data(buffer, F_VERTICES)
+    display.set_gl_viewport(0, 0, width, height)
+    return {"width": width, "height": height, "program": program, "buffer": buffer}
+
+def _fake_device(port, refresh_rate, gl_cost):
+    trio.run(lambda: run_fake_device('localhost', port, refresh_rate=refresh_rate, gl_cost=gl_cost))
+
+def run_benchmarks(http_port=8090, ws_port=8098, transport="queue", refresh_rate=1000, gl_cost=0.0, scale=1.0, only=None):
+    connector.run(host='127.0.0.1', http_port=http_port, ws_port=ws_port, transport=transport)
+    device = Process(target=_fake_device, args=(ws_port, refresh_rate, gl_cost), daemon=True)
+    device.start()
+    try:
+        display = connector.Display()
+        display.wait_connected(10)
+        scene = setup_scene(display)
+        results = []
+        for bench, count, kwargs in workloads(scale):
+            name = bench.__name__[len("bench_"):]
+            if only and name not in only:
+                continue
+            # A short warm up, so the first run doesn't pay for any setup
+            bench(display, scene, max(1, count // 10), **kwargs)
+            results.append(bench(display, scene, count, **kwargs))
+        return results
+    finally:
+        device.kill()
+        connector.shutdown()
+
+def _key(result):
+    return "%s %s" % (result['name'], " ".join("%s=%s" % item for item in sorted(result['params'].items())))
+
+def report(results, baseline=None):
+    baseline = {_key(r): r for r in baseline or ()}
+    lines = ["%-28s %20s %9s %9s %9s %9s" % ("workload", "rate", "MB/s", "p50 ms", "p90 ms", "p99 ms")]
+    for result in results:
+        latency = result['latency_ms']
+        line = "%-28s %10.0f %-9s %9.2f %9.3f %9.3f %9.3f" % (
+            _key(result), result['rate'], result['unit'] + "/s", result['bytes_per_sec'] / 1e6,
+            latency['p50'], latency['p90'], latency['p99'])
+        # Against the baseline run, higher is better for the rate
+        base = baseline.get(_key(result))
+        if base is not None:
+            line += "  rate %+.1f%% p50 %+.1f%%" % (
+                (result['rate'] / base['rate'] - 1) * 100,
+                (latency['p50'] / base['latency_ms']['p50'] - 1) * 100)
+        lines.append(line)
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pydish against a headless fake device")
+    parser.add_argument("--transport", default="queue", choices=("queue", "shm"))
+    parser.add_argument("--refresh-rate", type=float, default=1000, help="fake device refreshes per second")
+    parser.add_argument("--gl-cost", type=float, default=0.0, help="simulated seconds per command")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies every workload's length")
+    parser.add_argument("--only", nargs="*", help="workloads to run, e.g. uploads draws")
+    parser.add_argument("--http-port", type=int, default=8090)
+    parser.add_argument("--ws-port", type=int, default=8098)
+    parser.add_argument("--save", help="write the results as json")
+    parser.add_argument("--compare", help="json results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.http_port, args.ws_port, args.transport,
+        args.refresh_rate, args.gl_cost, args.scale, args.only)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print(report(results, baseline))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({"transport": args.transport, "gl_cost": args.gl_cost, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Mathew Young
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from array import array
+
+from .async_display import AsyncDisplay
+
+FLOAT32_SIZE = 4
+
+class MirroredBuffer(object):
+    # A Python side copy of a device buffer. Writes mark the touched range as
+    # dirty and flush() uploads only those spans with buffer_update_sub_data.
+    # Dirty ranges closer together than merge_gap floats are sent as one span,
+    # trading a few resent floats for fewer messages. With an AsyncDisplay
+    # the buffer has to be created (and awaited) first.
+    def __init__(self, display, data, buffer=None, merge_gap=64):
+        if buffer is None and isinstance(display, AsyncDisplay):
+            raise ValueError("pass the buffer in with an AsyncDisplay, e.g. buffer=await display.create_buffer()")
+        self.display = display
+        self.buffer = display.create_buffer() if buffer is None else buffer
+        self.data = array('f', data)
+        self.merge_gap = merge_gap
+        self._dirty = []
+        self._uploaded = False
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self.data))
+            if step != 1:
+                raise ValueError("only contiguous slices can be assigned")
+            if len(value) != stop - start:
+                raise ValueError("a mirrored buffer can't be resized by slice assignment")
+            self.data[start:stop] = array('f', value)
+            self.mark_dirty(start, stop)
+        else:
+            if index < 0:
+                index += len(self.data)
+            self.data[index] = value
+            self.mark_dirty(index, index + 1)
+
+    def mark_dirty(self, start, stop):
+        if stop > start:
+            self._dirty.append((start, stop))
+
+    def resize(self, data):
+        self.data = array('f', data)
+        self._dirty = []
+        self._uploaded = False
+
+    def dirty_ranges(self):
+        ranges = []
+        for start, stop in sorted(self._dirty):
+            if ranges and start <= ranges[-1][1] + self.merge_gap:
+                if stop > ranges[-1][1]:
+                    ranges[-1][1] = stop
+            else:
+                ranges.append([start, stop])
+        return [(start, stop) for start, stop in ranges]
+
+    def flush(self):
+        if not self._uploaded:
+            self.display.buffer_update_data(self.buffer, self.data)
+            self._uploaded = True
+        else:
+            view = memoryview(self.data)
+            for start, stop in self.dirty_ranges():
+                self.display.buffer_update_sub_data(self.buffer, start * FLOAT32_SIZE, view[start:stop])
+        self._dirty = []
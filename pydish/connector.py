@@ -14,281 +14,1150 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import json
+import math
+import struct
+import threading
 import time
 import trio
 
+from array import array
+from collections import deque
+from contextlib import contextmanager
 from functools import partial
-from multiprocessing import Process, Queue
+from multiprocessing import Event, Process, Queue
+from queue import Empty, Queue as LocalQueue
 from trio_websocket import serve_websocket, ConnectionClosed
+from urllib.parse import unquote
 
+# Created by run(), importing the module doesn't start or allocate anything
 CONNECTOR_PROCESS = None
-CONNECTOR_DISPLAY_API_RECV = Queue()
-CONNECTOR_API_SEND = Queue()
-CONNECTOR_INPUT_API_RECV = Queue()
+CONNECTOR_REPLY_ROUTER = None
+CONNECTOR_DISPLAY_API_RECV = None
+CONNECTOR_API_SEND = None
+CONNECTOR_INPUT_API_RECV = None
+# Seconds run() took to start the connector process and bind its sockets
+CONNECTOR_STARTUP_TIME = None
 
 from . import http_server
+from .journal import Journal, RESTORE_ID
+from .metrics import Metrics
+from .tracing import Tracer
+from .shm_ring import RingQueue, DEFAULT_RING_SIZE
 # import http_server
 
-async def main(display_recv, input_recv, api_send):
+DEFAULT_SESSION = "default"
+
+class Session(object):
+    # A named display, commands for it queue up here until a device attaches
+    def __init__(self, name):
+        self.name = name
+        self.send_channel, self.receive_channel = trio.open_memory_channel(math.inf)
+        self.ws = None
+        # What's needed to bring a new device (e.g. after a page reload) back
+        # to where the last one was: the journalled state, then the commands
+        # that were sent but never answered
+        self.journal = Journal()
+        self.unacked = {}
+        # (time, frame number) reported by the device over the last few
+        # seconds, for the presented frame rate
+        self.frames = deque()
+
+    def encode(self, msg):
+        # Binary payloads follow the json message as their own binary frames,
+        # the json only carries how many to expect
+        binary = msg.pop('binary', ())
+        msg['binary'] = len(binary)
+        return json.dumps(msg), binary
+
+FPS_WINDOW = 2.0
+
+async def serve_connector(next_command, on_display, on_input, host='0.0.0.0', port=8088, metrics=None, *, task_status=trio.TASK_STATUS_IGNORED):
+    sessions = {}
+    metrics = Metrics() if metrics is None else metrics
+
+    def get_session(name):
+        if name not in sessions:
+            sessions[name] = Session(name)
+        return sessions[name]
+
+    def collect(metrics):
+        now = time.perf_counter()
+        for session in sessions.values():
+            metrics.set("pydish_queued_commands", session.receive_channel.statistics().current_buffer_used, session=session.name)
+            metrics.set("pydish_unanswered_commands", len(session.unacked), session=session.name)
+            metrics.set("pydish_device_connected", int(session.ws is not None), session=session.name)
+            while session.frames and session.frames[0][0] < now - FPS_WINDOW:
+                session.frames.popleft()
+            fps = 0.0
+            if len(session.frames) > 1 and session.frames[-1][0] > session.frames[0][0]:
+                fps = (session.frames[-1][1] - session.frames[0][1]) / (session.frames[-1][0] - session.frames[0][0])
+            metrics.set("pydish_frames_per_second", fps, session=session.name)
+    metrics.add_collector(collect)
+
+    def answer(session, msg):
+        # Requests for the connector itself rather than the device
+        func = msg['msg']['func']
+        response = {"func": func, "status": 0, "status_msg": "success", "data": {}}
+        if func == "stats":
+            response['data'] = metrics.snapshot()
+        else:
+            response.update(status=1, status_msg="unknown connector request (%s)" % func)
+        on_display({"type": "connector", "session": session.name, "id": msg['id'], "response": response})
+
+    async def route_commands():
+        while True:
+            msg = await next_command()
+            if 'trace' in msg:
+                msg['trace']['dequeue'] = time.time()
+            session = get_session(msg.pop('session', DEFAULT_SESSION))
+            if msg.get('api') == 'connector':
+                answer(session, msg)
+            else:
+                session.send_channel.send_nowait(msg)
+
     async def connector_server(request):
+        # Devices pick their session with the websocket path, ws://host:port/<session>,
+        # which connector.js percent-encodes
+        session = get_session(unquote(request.path.split('?')[0].strip('/')) or DEFAULT_SESSION)
+        if session.ws is not None:
+            await request.reject(409, body=b"a device is already attached to this session")
+            return
         ws = await request.accept()
-        while True:
-            try:
-                msg = json.dumps(await trio.to_thread.run_sync(api_send.get))
-                await ws.send_message(msg)
-                msg = json.loads(await ws.get_message())
+        session.ws = ws
+        restore = session.journal.replay(skip=session.unacked)
+        # With a journal to replay the device ends up as the last one was left,
+        # otherwise it starts with no state and the Display drops its caches
+        on_display({"type": "connector", "session": session.name, "event": "device_connected", "restored": restore is not None, "time": time.time()})
+
+        async def send(text, binary):
+            await ws.send_message(text)
+            for payload in binary:
+                await ws.send_message(payload)
+
+        # Messages are tagged with request ids, so outgoing commands don't
+        # need to wait for the previous reply before being sent
+        async def sender():
+            if restore is not None:
+                await send(*session.encode(restore))
+            for text, binary, func, sent in list(session.unacked.values()):
+                await send(text, binary)
+            while True:
+                msg = await session.receive_channel.receive()
+                if msg.get('api') == 'display':
+                    session.journal.assign_ids(msg['msg'])
+                    session.journal.record(msg['id'], msg['msg'], msg.get('binary', ()))
+                if 'trace' in msg:
+                    msg['trace']['send'] = time.time()
+                text, binary = session.encode(msg)
+                func = msg['msg']['func']
+                # Kept until answered, in case the device goes away first
+                session.unacked[msg['id']] = (text, binary, func, time.perf_counter())
+                metrics.inc("pydish_sent_messages_total", session=session.name, func=func)
+                metrics.inc("pydish_sent_bytes_total", len(text) + sum(len(payload) for payload in binary), session=session.name, func=func)
+                await send(text, binary)
+
+        async def receiver():
+            while True:
+                text = await ws.get_message()
+                msg = json.loads(text)
+                sent = session.unacked.pop(msg.get('id'), None)
+                if sent is not None:
+                    func = sent[2]
+                    metrics.observe("pydish_device_latency_seconds", time.perf_counter() - sent[3], session=session.name, func=func)
+                    metrics.inc("pydish_received_bytes_total", len(text), session=session.name, func=func)
+                    # Time the firmware spent running the command
+                    if 'handler_ms' in msg:
+                        metrics.observe("pydish_device_handler_seconds", msg.pop('handler_ms') / 1000.0, session=session.name, func=func)
+                if 'trace' in msg:
+                    msg['trace']['reply'] = time.time()
+                if 'frame' in msg:
+                    now = time.perf_counter()
+                    frame = msg.pop('frame')
+                    # The count starts again when the display is initialised
+                    if session.frames and frame < session.frames[-1][1]:
+                        session.frames.clear()
+                    session.frames.append((now, frame))
+                    while session.frames[0][0] < now - FPS_WINDOW:
+                        session.frames.popleft()
+                # The replayed journal is only answered to the connector
+                if msg.get('id') == RESTORE_ID:
+                    continue
+                msg['session'] = session.name
                 if msg['type'] == 'display':
-                    display_recv.put_nowait(msg)
+                    on_display(msg)
                 elif msg['type'] == 'input':
-                    input_recv.put_nowait(msg)
+                    on_input(msg)
                 else:
                     raise ValueError("[API message] unknown api type")
+
+        async def guarded(task, cancel_scope):
+            try:
+                await task()
             except ConnectionClosed:
-                print("[CONNECTOR] CONNECTION CLOSED")
-                return
+                cancel_scope.cancel()
+
+        try:
+            async with trio.open_nursery() as n:
+                n.start_soon(guarded, sender, n.cancel_scope)
+                n.start_soon(guarded, receiver, n.cancel_scope)
+        finally:
+            session.ws = None
+            on_display({"type": "connector", "session": session.name, "event": "device_disconnected"})
+        print("[CONNECTOR] CONNECTION CLOSED (session %s)" % session.name)
+
     async with trio.open_nursery() as n:
-        n.start_soon(http_server.http_main)
-        n.start_soon(partial(serve_websocket, connector_server, '0.0.0.0', 8088, ssl_context=None))
+        n.start_soon(route_commands)
+        server = await n.start(serve_websocket, connector_server, host, port, None)
+        task_status.started(server)
+
+def _post_commands(channel, msgs):
+    for msg in msgs:
+        channel.send_nowait(msg)
 
-def start_server(display_recv, input_recv, api_send):
-    trio.run(main, display_recv, input_recv, api_send)
+def _queue_reader(api_send, trio_token, channel, max_messages=64):
+    # Runs in its own thread for the life of the connector. Everything that is
+    # already waiting in the queue is handed over to trio in one go, so a burst
+    # of commands costs a single wakeup of the event loop.
+    while True:
+        msgs = [api_send.get()]
+        try:
+            while len(msgs) < max_messages:
+                msgs.append(api_send.get_nowait())
+        except Empty:
+            pass
+        try:
+            trio_token.run_sync_soon(_post_commands, channel, msgs)
+        except trio.RunFinishedError:
+            return
+
+async def main(display_recv, input_recv, api_send, host='0.0.0.0', http_port=8080, ws_port=8088, ready=None):
+    send_channel, receive_channel = trio.open_memory_channel(math.inf)
+    threading.Thread(target=_queue_reader, daemon=True, args=(
+        api_send, trio.lowlevel.current_trio_token(), send_channel
+    )).start()
+    # Shared so /metrics serves what the connector records
+    metrics = Metrics()
+    async with trio.open_nursery() as n:
+        await n.start(partial(http_server.http_main, host=host, port=http_port, ws_port=ws_port, metrics=metrics))
+        await n.start(serve_connector, receive_channel.receive, display_recv.put_nowait, input_recv.put_nowait, host, ws_port, metrics)
+        # Both servers are listening, devices can connect from here on
+        if ready is not None:
+            ready.set()
 
-def run():
-    global CONNECTOR_PROCESS
-    global CONNECTOR_API_SEND
-    global CONNECTOR_INPUT_API_RECV, CONNECTOR_INPUT_API_SEND
+def start_server(display_recv, input_recv, api_send, host, http_port, ws_port, ready=None):
+    trio.run(main, display_recv, input_recv, api_send, host, http_port, ws_port, ready)
+
+def run(host='0.0.0.0', http_port=8080, ws_port=8088, transport="queue", ring_size=DEFAULT_RING_SIZE, timeout=10):
+    # Returns once the connector's sockets are bound, raises RuntimeError if
+    # the process dies (e.g. a port is in use) or isn't ready within timeout
+    global CONNECTOR_PROCESS, CONNECTOR_REPLY_ROUTER, CONNECTOR_STARTUP_TIME
+    global CONNECTOR_API_SEND, CONNECTOR_DISPLAY_API_RECV, CONNECTOR_INPUT_API_RECV
 
     if CONNECTOR_PROCESS is None:
+        started = time.perf_counter()
+        # The shared memory rings replace the pickling queues for the display
+        # api, input events are rare enough to stay on a Queue
+        if transport == "shm":
+            CONNECTOR_API_SEND = RingQueue(ring_size)
+            CONNECTOR_DISPLAY_API_RECV = RingQueue(ring_size)
+        elif transport == "queue":
+            CONNECTOR_API_SEND = Queue()
+            CONNECTOR_DISPLAY_API_RECV = Queue()
+        else:
+            raise ValueError("unknown connector transport (%s), must be in (queue, shm)" % transport)
+        CONNECTOR_INPUT_API_RECV = Queue()
+
+        ready = Event()
         CONNECTOR_PROCESS = Process(target=start_server, args=(
             CONNECTOR_DISPLAY_API_RECV, CONNECTOR_INPUT_API_RECV,
-            CONNECTOR_API_SEND
+            CONNECTOR_API_SEND, host, http_port, ws_port, ready
         ))
         CONNECTOR_PROCESS.start()
+        deadline = started + timeout
+        while not ready.wait(0.01):
+            if not CONNECTOR_PROCESS.is_alive() or time.perf_counter() > deadline:
+                exitcode = CONNECTOR_PROCESS.exitcode
+                shutdown()
+                raise RuntimeError("the connector failed to start (exit code %s)" % exitcode)
+        CONNECTOR_REPLY_ROUTER = ReplyRouter(CONNECTOR_DISPLAY_API_RECV)
+        CONNECTOR_STARTUP_TIME = time.perf_counter() - started
 
 def shutdown():
-    global CONNECTOR_PROCESS
+    global CONNECTOR_PROCESS, CONNECTOR_REPLY_ROUTER
+    global CONNECTOR_API_SEND, CONNECTOR_DISPLAY_API_RECV, CONNECTOR_INPUT_API_RECV
 
     if CONNECTOR_PROCESS is not None:
         CONNECTOR_PROCESS.kill()
         CONNECTOR_PROCESS.join()
         CONNECTOR_PROCESS = None
+        CONNECTOR_REPLY_ROUTER = None
+
+        if isinstance(CONNECTOR_API_SEND, RingQueue):
+            CONNECTOR_API_SEND.close()
+        if isinstance(CONNECTOR_DISPLAY_API_RECV, RingQueue):
+            CONNECTOR_DISPLAY_API_RECV.close()
+        CONNECTOR_API_SEND = None
+        CONNECTOR_DISPLAY_API_RECV = None
+        CONNECTOR_INPUT_API_RECV = None
+
+class ReplyRouter(object):
+    # Replies for every session share one queue out of the connector process,
+    # this thread sorts them into a local queue per session
+    def __init__(self, recvq):
+        self.recvq = recvq
+        self.queues = {}
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def queue_for(self, session):
+        with self.lock:
+            if session not in self.queues:
+                self.queues[session] = LocalQueue()
+            return self.queues[session]
+
+    def _run(self):
+        while True:
+            msg = self.recvq.get()
+            self.queue_for(msg.get('session', DEFAULT_SESSION)).put(msg)
+
+def _uniform_key(value):
+    try:
+        return tuple(value)
+    except TypeError:
+        return value
+
+def _dict_changes(before, after):
+    # What turns before into after: the changed entries and the removed keys
+    changed = {key: value for key, value in after.items() if key not in before or before[key] != value}
+    return changed, [key for key in before if key not in after]
+
+def _apply_changes(d, changes):
+    changed, removed = changes
+    for key in removed:
+        d.pop(key, None)
+    d.update(changed)
+
+VERTEX_TYPECODES = {
+    "float32": 'f',
+    "float16": 'e',
+    "int8": 'b',
+    "uint8": 'B',
+    "int16": 'h',
+    "uint16": 'H',
+    "int32": 'i',
+    "uint32": 'I'
+}
+
+# The buffer protocol formats of each kind of number
+FLOAT_FORMATS = "efd"
+INT_FORMATS = "bBhHiIlLqQnN"
 
-class Display(object):
+def _buffer_bytes(data, typecode, name):
+    # The contents of a buffer protocol object as typecode numbers. Plain
+    # bytes (e.g. from struct.pack) are taken as already laid out for the
+    # device, other numbers are converted, never reinterpreted
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data)
+    view = memoryview(data)
+    fmt = view.format.lstrip('@=<')
+    if fmt == typecode:
+        return view.tobytes()
+    if fmt not in FLOAT_FORMATS + INT_FORMATS:
+        raise ValueError("can't send data of format %s as %s" % (view.format, name))
+    if fmt in FLOAT_FORMATS and typecode not in FLOAT_FORMATS:
+        raise ValueError("float data can't be sent as %s, convert it first" % name)
+
+    if hasattr(data, 'astype'):
+        # numpy arrays convert without going through Python numbers
+        converted = data.astype(name)
+        if typecode in INT_FORMATS and (converted != data).any():
+            raise ValueError("values out of range for %s" % name)
+        return converted.tobytes()
+    if view.ndim != 1:
+        view = memoryview(view.tobytes()).cast(fmt)
+    try:
+        # array has no half float typecode
+        if typecode == 'e':
+            return struct.pack('<%de' % len(view), *view)
+        return array(typecode, view).tobytes()
+    except OverflowError:
+        raise ValueError("values out of range for %s" % name)
+
+def _vertex_bytes(data, dtype="float32"):
+    if isinstance(data, (list, tuple)):
+        if dtype == "float16":
+            return struct.pack('<%de' % len(data), *data)
+        return array(VERTEX_TYPECODES[dtype], data).tobytes()
+    return _buffer_bytes(data, VERTEX_TYPECODES[dtype], dtype)
+
+INDEX_TYPECODES = {
+    "uint16": 'H',
+    "uint32": 'I'
+}
+
+def _index_bytes(data, index_type):
+    if isinstance(data, (list, tuple)):
+        return array(INDEX_TYPECODES[index_type], data).tobytes()
+    payload = _buffer_bytes(data, INDEX_TYPECODES[index_type], index_type)
+    # Only packed bytes can come out as a partial index
+    if len(payload) % array(INDEX_TYPECODES[index_type]).itemsize:
+        raise ValueError("%d bytes isn't a whole number of %s indices" % (len(payload), index_type))
+    return payload
+
+FRAME_POLICIES = ("block", "drop_oldest", "drop_newest")
+
+class DisplayError(Exception):
+    def __init__(self, func, status, status_msg):
+        super().__init__("[%s] status %s: %s" % (func, status, status_msg))
+        self.func = func
+        self.status = status
+        self.status_msg = status_msg
+
+class PendingCall(object):
+    def __init__(self, display, request_id, result=None):
+        self.display = display
+        self.request_id = request_id
+        self.response = None
+        self._result = result
+        self.sent = time.perf_counter()
+
+    def done(self):
+        return self.response is not None
+
+    def result(self):
+        if self.response is None:
+            self.display._wait_for(self.request_id)
+        if self.response['status'] != 0:
+            # The error is being reported here, so don't raise it again at the next sync point
+            if self in self.display._errors:
+                self.display._errors.remove(self)
+            raise DisplayError(self.response.get('func'), self.response['status'], self.response['status_msg'])
+        if self._result is None:
+            return None
+        return self._result(self.response['data'])
+
+class Bundle(object):
+    # Handle returned by record_bundle, the id is filled in once the recorded
+    # commands are stored on the device
     def __init__(self):
-        if CONNECTOR_PROCESS is None:
-            run()
-        self.recvq = CONNECTOR_DISPLAY_API_RECV
-        self.sendq = CONNECTOR_API_SEND
-    
+        self.id = None
+
+def _bundle_resources(commands):
+    programs = set()
+    buffers = set()
+    for msg in commands:
+        if msg['func'] in ("program_update_uniforms", "program_link_attributes", "execute_program"):
+            programs.add(msg['args'][0])
+        elif msg['func'] in ("buffer_update_data", "buffer_update_sub_data"):
+            buffers.add(msg['args'][0])
+        elif msg['func'] == "index_buffer_update_data":
+            buffers.add(("index", msg['args'][0]))
+    return programs, buffers
+
+def _presents(response):
+    if response.get('func') == "batch":
+        return any(_presents(r) for r in response.get('data', {}).get('responses', ()))
+    return response.get('func') == "update_canvas" and response.get('status') == 0
+
+class BaseDisplay(object):
+    # The display api shared by Display and AsyncDisplay, subclasses provide
+    # the transport through _send and _call
+    _pending_class = PendingCall
+
+    def __init__(self, session=DEFAULT_SESSION):
+        self.session = session
+        self._batch = None
+        self._binary = []
+        self._batch_binary = []
+        self._batch_caches = None
+        self._next_request_id = 0
+        self._pending = {}
+        self._errors = []
+        # Digest of the last payload uploaded to each buffer, so uploads the
+        # device already has can be skipped
+        self._buffer_digests = {}
+        self.upload_stats = {
+            "uploads": 0,
+            "uploaded_bytes": 0,
+            "skipped_uploads": 0,
+            "skipped_bytes": 0
+        }
+        # Last value sent for each (program, uniform)
+        self._uniform_cache = {}
+        self._index_types = {}
+        # Programs and buffers each bundle changes when it is played
+        self._bundles = {}
+        self._bypass_caches = False
+        self._connected = False
+        # perf_counter() times of the steps to the first frame, see
+        # time_to_first_frame
+        self._startup_times = {"created": time.perf_counter()}
+        # Round trips as seen by the app, the connector keeps its own
+        self.metrics = Metrics()
+        self.tracer = None
+
+    def _invalidate_caches(self):
+        self._buffer_digests.clear()
+        self._uniform_cache.clear()
+
+    def _forget_resources(self, programs, buffers):
+        for key in [key for key in self._uniform_cache if key[0] in programs]:
+            del self._uniform_cache[key]
+        for key in buffers:
+            self._buffer_digests.pop(key, None)
+
+    def _forget_device(self):
+        # The device lost every resource, bundles included
+        self._invalidate_caches()
+        self._bundles.clear()
+
+    def _dispatch(self, r):
+        if r.get('type') == 'connector' and 'event' in r:
+            if r['event'] == 'device_connected':
+                self._connected = True
+                # Stamped by the connector when the device attached, on the
+                # wall clock as it's another process
+                self._startup_times.setdefault("connected", time.perf_counter() - max(0, time.time() - r['time']))
+                if not r.get('restored'):
+                    self._forget_device()
+            elif r['event'] == 'device_disconnected':
+                self._connected = False
+            return
+        pending = self._pending.pop(r.get('id'), None)
+        if pending is None:
+            return
+        pending.response = r['response']
+        if self.tracer is not None and 'trace' in r:
+            self.tracer.record(self.session, pending.request_id, pending.response.get('func'), r['trace'], time.time())
+        self.metrics.observe("pydish_display_latency_seconds", time.perf_counter() - pending.sent, session=self.session, func=pending.response.get('func'))
+        if "first_frame" not in self._startup_times and _presents(pending.response):
+            self._startup_times["first_frame"] = time.perf_counter()
+        if pending.response['status'] != 0:
+            self._errors.append(pending)
+            # Not sure what made it onto the device any more
+            self._invalidate_caches()
+
+    def _receive_events(self):
+        pass
+
+    @property
+    def connected(self):
+        # Whether a device is attached to the session, as of the latest
+        # connector event
+        self._receive_events()
+        return self._connected
+
+    def _raise_errors(self):
+        if self._errors:
+            pending = self._errors.pop(0)
+            raise DisplayError(pending.response.get('func'), pending.response['status'], pending.response['status_msg'])
+
+    def _prepare(self, func, args=None, kwargs=None, result=None, api="display"):
+        msg = {
+            "func": func,
+            "args": [] if args is None else args,
+            "kwargs": {} if kwargs is None else kwargs
+        }
+        # While a batch is being recorded calls are only queued up, so there
+        # is no response (or returned id) until the batch is submitted
+        if self._batch is not None:
+            self._batch.append(msg)
+            return None
+        binary, self._binary = self._binary, []
+
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        pending = self._pending_class(self, request_id, result)
+        msg = {
+            "api": api,
+            "session": self.session,
+            "id": request_id,
+            "msg": msg,
+            "binary": binary
+        }
+        # Traced commands collect timestamps on the way to the device and back
+        if self.tracer is not None:
+            msg['trace'] = {"enqueue": time.time()}
+        # Only a sent message can be answered, one that failed to send (e.g.
+        # too big for the ring) mustn't be waited for, and the caches may
+        # already count its contents as on the device
+        try:
+            self._send(msg)
+        except BaseException:
+            self._invalidate_caches()
+            raise
+        self._pending[request_id] = pending
+        return pending
+
+    def _completed(self, func, result=None):
+        pending = self._pending_class(self, None, result)
+        pending.response = {"func": func, "status": 0, "status_msg": "success", "data": {}}
+        return pending
+
+    def _upload_changed(self, key, payload):
+        # Uploads recorded into bundles may happen later or not at all, so
+        # they can't be compared with (or stand in for) what the device has
+        if not self._bypass_caches:
+            digest = hashlib.blake2b(payload, digest_size=16).digest()
+            if self._buffer_digests.get(key) == digest:
+                self.upload_stats['skipped_uploads'] += 1
+                self.upload_stats['skipped_bytes'] += len(payload)
+                return False
+            self._buffer_digests[key] = digest
+        self.upload_stats['uploads'] += 1
+        self.upload_stats['uploaded_bytes'] += len(payload)
+        return True
+
+    def _attach(self, payload):
+        attachments = self._binary if self._batch is None else self._batch_binary
+        attachments.append(payload)
+        return {"binary": len(attachments) - 1}
+
+    def _cache_state(self):
+        return dict(self._buffer_digests), dict(self._uniform_cache), dict(self.upload_stats)
+
+    def begin_batch(self):
+        if self._batch is not None:
+            raise RuntimeError("a batch is already being recorded")
+        self._batch = []
+        # Recorded calls update the caches straight away, a discarded batch
+        # never reaches the device so they go back to how they were
+        self._batch_caches = self._cache_state()
+
+    def _end_batch(self):
+        if self._batch is None:
+            raise RuntimeError("no batch is being recorded")
+        commands, self._batch = self._batch, None
+        self._binary, self._batch_binary = self._batch_binary, []
+        self._bypass_caches = False
+        return commands
+
+    def _discard_batch(self):
+        self._batch = None
+        self._batch_binary = []
+        self._bypass_caches = False
+        self._buffer_digests, self._uniform_cache, self.upload_stats = self._batch_caches
+
+    def submit(self, wait=True):
+        commands = self._end_batch()
+        if not commands:
+            return []
+        return self._call("batch", [commands], result=lambda data: data['responses'], wait=wait)
+
+    @contextmanager
+    def batch(self):
+        self.begin_batch()
+        try:
+            yield self
+        except BaseException:
+            self._discard_batch()
+            raise
+        self.submit()
+
+    @contextmanager
+    def frame(self):
+        with self.batch():
+            yield self
+            self.update_canvas()
+
+    def _store_bundle(self, bundle, commands):
+        resources = _bundle_resources(commands)
+
+        def stored(data):
+            bundle.id = data['id']
+            self._bundles[bundle.id] = resources
+            return bundle.id
+
+        return self._call("record_bundle", [commands], result=stored)
+
+    @contextmanager
+    def record_bundle(self):
+        # Calls made inside are stored on the device instead of run, the
+        # returned Bundle's id can then be replayed with play_bundle
+        bundle = Bundle()
+        self.begin_batch()
+        self._bypass_caches = True
+        try:
+            yield bundle
+        except BaseException:
+            self._discard_batch()
+            raise
+        self._store_bundle(bundle, self._end_batch())
+
+    def play_bundle(self, bundle, overrides=None):
+        # overrides patches uniform values, every program_update_uniforms in
+        # the bundle that sets one of the named uniforms uses the new value
+        bundle = getattr(bundle, 'id', bundle)
+        self._forget_resources(*self._bundles.get(bundle, ((), ())))
+
+        return self._call("play_bundle", [
+            bundle
+        ], {
+            'overrides': {} if overrides is None else overrides
+        }, wait=False)
+
+    def delete_bundle(self, bundle):
+        bundle = getattr(bundle, 'id', bundle)
+        self._bundles.pop(bundle, None)
+        return self._call("delete_bundle", [
+            bundle
+        ], wait=False)
+
     def init_display(self):
-        self.sendq.put_nowait({
-            "api": "display",
-            "msg": {
-                "func": "init_display",
-                "args": [],
-                "kwargs": {}
-            }
-        })
-        r = self.recvq.get()
-        print(r)
-        return None
+        self._forget_device()
+        return self._call("init_display")
     
     def set_gl_viewport(self, origin_x, origin_y, width, height):
-        self.sendq.put_nowait({
-            "api": "display",
-            "msg": {
-                "func": "set_gl_viewport",
-                "args": [
-                    origin_x, origin_y,
-                    width, height
-                ],
-                "kwargs": {}
-            }
-        })
-        r = self.recvq.get()
-        print(r)
-        return None
+        return self._call("set_gl_viewport", [
+            origin_x, origin_y,
+            width, height
+        ], wait=False)
     
     def set_gl_clear_color(self, r, g, b, a):
-        self.sendq.put_nowait({
-            "api": "display",
-            "msg": {
-                "func": "set_gl_clear_color",
-                "args": [
-                    r, g, b, a
-                ],
-                "kwargs": {}
-            }
-        })
-        r = self.recvq.get()
-        print(r)
-        return None
+        return self._call("set_gl_clear_color", [
+            r, g, b, a
+        ], wait=False)
     
     def clear(self):
-        self.sendq.put_nowait({
-            "api": "display",
-            "msg": {
-                "func": "clear",
-                "args": [],
-                "kwargs": {}
-            }
-        })
-        r = self.recvq.get()
-        print(r)
-        return None
+        return self._call("clear", wait=False)
     
-    def update_canvas(self):
-        self.sendq.put_nowait({
-            "api": "display",
-            "msg": {
-                "func": "update_canvas",
-                "args": [],
-                "kwargs": {}
-            }
-        })
-        r = self.recvq.get()
-        print(r)
-        return None
+    def update_canvas(self, vsync=True):
+        # The device presents the frame at its next animation frame, with
+        # vsync=False it is presented as soon as the message arrives
+        kwargs = {}
+        if not vsync:
+            kwargs['vsync'] = False
+        return self._present(kwargs)
+
+    def _present(self, kwargs):
+        return self._call("update_canvas", [], kwargs)
+
+    def start_tracing(self, max_commands=100000):
+        # Commands sent from now on are traced through the connector and the
+        # firmware, until stop_tracing
+        self.tracer = Tracer(max_commands)
+
+    def stop_tracing(self, path=None):
+        # Writes the trace as Chrome trace event json (for Perfetto or
+        # chrome://tracing) when given a path, returns the Tracer
+        tracer, self.tracer = self.tracer, None
+        if tracer is not None and path is not None:
+            tracer.save(path)
+        return tracer
+
+    def set_gpu_timing(self, enabled=True):
+        # Times every execute_program (and the clears and present around
+        # them) on the GPU with timer queries, which needs the device to
+        # support EXT_disjoint_timer_query_webgl2. Collected with gpu_timings
+        return self._call("set_gpu_timing", [
+            enabled
+        ], wait=False)
+
+    def gpu_timings(self):
+        # The GPU timings completed since the last call, oldest first: one
+        # dict per draw with its program, the frame it was drawn in and
+        # gpu_ms, and one per frame (kind "frame") with the frame's total
+        # gpu_ms and number of draws. Results lag a few frames behind, they
+        # are also added to the metrics reported by stats()
+        if self._batch is not None:
+            raise RuntimeError("gpu_timings can't be called while recording a batch")
+
+        def collected(data):
+            for timing in data['timings']:
+                if timing['kind'] == "draw":
+                    self.metrics.observe("pydish_gpu_draw_seconds", timing['gpu_ms'] / 1000.0, session=self.session, program=timing['program'])
+                else:
+                    self.metrics.observe("pydish_gpu_frame_seconds", timing['gpu_ms'] / 1000.0, session=self.session)
+            if data['dropped']:
+                self.metrics.inc("pydish_gpu_timings_dropped_total", data['dropped'], session=self.session)
+            if data['disjoint']:
+                self.metrics.inc("pydish_gpu_timings_disjoint_total", data['disjoint'], session=self.session)
+            return data['timings']
+
+        return self._call("gpu_timings", result=collected)
+
+    def stats(self):
+        # Latency histograms and counters from this display and from the
+        # connector (round trips to the device, firmware handler time, bytes
+        # on the wire, queue depths, frame rate), as nested dicts
+        if self._batch is not None:
+            raise RuntimeError("stats can't be called while recording a batch")
+        self.metrics.set("pydish_pending_calls", len(self._pending), session=self.session)
+        display = self.metrics.snapshot()
+        uploads = dict(self.upload_stats)
+
+        return self._call("stats", result=lambda data: {
+            "display": display,
+            "connector": data,
+            "uploads": uploads
+        }, api="connector")
+
+    def next_frame(self):
+        # Blocks until the device is ready for a new frame, returns the frame
+        # number and the time (seconds since the epoch) of that refresh
+        if self._batch is not None:
+            raise RuntimeError("next_frame can't be called while recording a batch")
+        return self._call("wait_for_vsync", result=lambda data: (data['frame'], data['timestamp']))
+
+    wait_for_vsync = next_frame
+
+    def time_to_first_frame(self):
+        # Seconds spent on each step from creating the display to the device
+        # drawing its first frame, None until it has
+        times = self._startup_times
+        if "first_frame" not in times:
+            return None
+        connector_ready = times.get("connector_ready", times["created"])
+        connected = max(times.get("connected", connector_ready), connector_ready)
+        # The connector may have been started (by run()) before the display
+        # was created
+        connector_start = times.get("connector_start", connector_ready - times["created"])
+        return {
+            "connector_start": connector_start,
+            "device_connect": connected - connector_ready,
+            "first_frame": times["first_frame"] - connected,
+            "total": connector_start + times["first_frame"] - connector_ready
+        }
     
     def get_resolution(self):
-        self.sendq.put_nowait({
-            "api": "display",
-            "msg": {
-                "func": "get_resolution",
-                "args": [],
-                "kwargs": {}
-            }
-        })
-        r = self.recvq.get()
-        print(r)
-        return r['response']['data']['w'], r['response']['data']['h']
+        return self._call("get_resolution", result=lambda data: (data['w'], data['h']))
 
     def compile_vertex_shader(self, code):
-        self.sendq.put_nowait({
-            "api": "display",
-            "msg": {
-                "func": "compile_vertex_shader",
-                "args": [
-                    code
-                ],
-                "kwargs": {}
-            }
-        })
-        r = self.recvq.get()
-        print(r)
-        return r['response']['data']['id']
+        return self._call("compile_vertex_shader", [
+            code
+        ], result=lambda data: data['id'])
 
     def compile_fragment_shader(self, code):
-        self.sendq.put_nowait({
-            "api": "display",
-            "msg": {
-                "func": "compile_fragment_shader",
-                "args": [
-                    code
-                ],
-                "kwargs": {}
-            }
-        })
-        r = self.recvq.get()
-        print(r)
-        return r['response']['data']['id']
+        return self._call("compile_fragment_shader", [
+            code
+        ], result=lambda data: data['id'])
 
     def create_program(self, vertex_shader_id, fragment_shader_id, uniforms=None, attributes=None):
+        # Attributes are declared as {"size": n}, optionally with a divisor and
+        # their layout in the buffer: type ("float32" by default, "float16",
+        # "int8", "uint8", "int16", ...), normalized, stride and offset
         uniforms = {} if uniforms is None else uniforms
         attributes = {} if attributes is None else attributes
 
-        self.sendq.put_nowait({
-            "api": "display",
-            "msg": {
-                "func": "create_program",
-                "args": [
-                    vertex_shader_id,
-                    fragment_shader_id
-                ],
-                "kwargs": {
-                    'uniforms': uniforms,
-                    'attributes': attributes
-                }
-            }
-        })
-        r = self.recvq.get()
-        print(r)
-        return r['response']['data']['id']
+        return self._call("create_program", [
+            vertex_shader_id,
+            fragment_shader_id
+        ], {
+            'uniforms': uniforms,
+            'attributes': attributes
+        }, result=lambda data: data['id'])
+
+    def compile_programs(self, programs):
+        # Compiles and links all of the programs in one round trip, each is a
+        # dict with the vertex and fragment shader source and the uniforms and
+        # attributes as for create_program. Returns the program ids in order,
+        # any failures are reported together in one DisplayError
+        if self._batch is not None:
+            raise RuntimeError("compile_programs can't be called while recording a batch")
+
+        return self._call("compile_programs", [[{
+            'vertex': program['vertex'],
+            'fragment': program['fragment'],
+            'uniforms': program.get('uniforms', {}),
+            'attributes': program.get('attributes', {})
+        } for program in programs]], result=lambda data: data['ids'])
 
     def create_buffer(self):
-        self.sendq.put_nowait({
-            "api": "display",
-            "msg": {
-                "func": "create_buffer",
-                "args": [],
-                "kwargs": {}
-            }
-        })
-        r = self.recvq.get()
-        print(r)
-        return r['response']['data']['id']
-
-    def buffer_update_data(self, buffer, data):
-        self.sendq.put_nowait({
-            "api": "display",
-            "msg": {
-                "func": "buffer_update_data",
-                "args": [
-                    buffer,
-                    data
-                ],
-                "kwargs": {}
-            }
-        })
-        r = self.recvq.get()
-        print(r)
-        return None
+        return self._call("create_buffer", result=lambda data: data['id'])
+
+    def _check_dtype(self, dtype):
+        if dtype not in VERTEX_TYPECODES:
+            raise ValueError("unknown dtype (%s), must be in (%s)" % (dtype, ", ".join(VERTEX_TYPECODES)))
+
+    def buffer_update_data(self, buffer, data, dtype="float32"):
+        # Sent as a binary frame, data can be a list of numbers or anything
+        # supporting the buffer protocol (array, numpy arrays), converted to
+        # dtype, or bytes from struct.pack for interleaved layouts
+        self._check_dtype(dtype)
+        payload = _vertex_bytes(data, dtype)
+        if not self._upload_changed(buffer, payload):
+            return self._completed("buffer_update_data")
+
+        return self._call("buffer_update_data", [
+            buffer,
+            self._attach(payload)
+        ], wait=False)
+
+    def buffer_update_sub_data(self, buffer, offset, data, dtype="float32"):
+        # offset is in bytes from the start of the buffer, as with gl.bufferSubData
+        self._check_dtype(dtype)
+        payload = _vertex_bytes(data, dtype)
+        self._buffer_digests.pop(buffer, None)
+        self.upload_stats['uploads'] += 1
+        self.upload_stats['uploaded_bytes'] += len(payload)
+
+        return self._call("buffer_update_sub_data", [
+            buffer,
+            offset,
+            self._attach(payload)
+        ], wait=False)
+
+    def create_index_buffer(self, index_type="uint16"):
+        if index_type not in INDEX_TYPECODES:
+            raise ValueError("unknown index type (%s), must be in (uint16, uint32)" % index_type)
+
+        def created(data):
+            self._index_types[data['id']] = index_type
+            return data['id']
+
+        return self._call("create_index_buffer", [
+            index_type
+        ], result=created)
+
+    def index_buffer_update_data(self, buffer, data):
+        # Lists and buffer protocol objects (uint8 arrays included) are
+        # converted to the buffer's index type, bytes are sent as they are
+        payload = _index_bytes(data, self._index_types.get(buffer, "uint16"))
+        if not self._upload_changed(("index", buffer), payload):
+            return self._completed("index_buffer_update_data")
+
+        return self._call("index_buffer_update_data", [
+            buffer,
+            self._attach(payload)
+        ], wait=False)
+
+    def delete_buffer(self, buffer):
+        self._buffer_digests.pop(buffer, None)
+        return self._call("delete_buffer", [
+            buffer
+        ], wait=False)
+
+    def delete_index_buffer(self, buffer):
+        self._buffer_digests.pop(("index", buffer), None)
+        self._index_types.pop(buffer, None)
+        return self._call("delete_index_buffer", [
+            buffer
+        ], wait=False)
+
+    def delete_program(self, program):
+        for key in [key for key in self._uniform_cache if key[0] == program]:
+            del self._uniform_cache[key]
+        return self._call("delete_program", [
+            program
+        ], wait=False)
 
     def program_link_attributes(self, program, attribute_arrays):
-        self.sendq.put_nowait({
-            "api": "display",
-            "msg": {
-                "func": "program_link_attributes",
-                "args": [
-                    program,
-                    attribute_arrays
-                ],
-                "kwargs": {}
-            }
-        })
-        r = self.recvq.get()
-        print(r)
-        return None
+        # Each attribute maps to a buffer id, or to a dict with the buffer and
+        # any of type, normalized, stride and offset (in bytes) to override
+        # the layout declared in create_program, e.g. to interleave attributes
+        return self._call("program_link_attributes", [
+            program,
+            attribute_arrays
+        ], wait=False)
 
     def program_update_uniforms(self, program, uniform_values):
-        self.sendq.put_nowait({
-            "api": "display",
-            "msg": {
-                "func": "program_update_uniforms",
-                "args": [
-                    program,
-                    uniform_values
-                ],
-                "kwargs": {}
-            }
-        })
-        r = self.recvq.get()
-        print(r)
-        return None
-
-    def execute_program(self, program_id, draw_type):
-        self.sendq.put_nowait({
-            "api": "display",
-            "msg": {
-                "func": "execute_program",
-                "args": [
-                    program_id,
-                    draw_type
-                ],
-                "kwargs": {}
-            }
-        })
-        r = self.recvq.get()
-        print(r)
-        return None
\ No newline at end of file
+        # Only send the uniforms that changed since the last update
+        changed = {}
+        for name, value in uniform_values.items():
+            key = _uniform_key(value)
+            if self._bypass_caches:
+                changed[name] = value
+            elif self._uniform_cache.get((program, name)) != key:
+                self._uniform_cache[(program, name)] = key
+                changed[name] = value
+        if not changed:
+            return self._completed("program_update_uniforms")
+
+        return self._call("program_update_uniforms", [
+            program,
+            changed
+        ], wait=False)
+
+    def execute_program(self, program_id, draw_type, instances=None, index_buffer=None, first=0, count=None):
+        # With instances the draw is repeated that many times in one call,
+        # attributes declared with a "divisor" in create_program step per instance.
+        # With an index_buffer vertices are drawn in the order of its indices,
+        # optionally only count of them starting at index first.
+        kwargs = {}
+        if instances is not None:
+            kwargs['instances'] = instances
+        if index_buffer is not None:
+            kwargs['index_buffer'] = index_buffer
+            kwargs['first'] = first
+            kwargs['count'] = count
+
+        return self._call("execute_program", [
+            program_id,
+            draw_type
+        ], kwargs, wait=False)
+
+class Display(BaseDisplay):
+    # max_frames_in_flight caps how many frames can be sent to the device
+    # without having been drawn yet. With frame_policy "block" the producer
+    # waits for a free slot, with "drop_newest" a frame submitted while the
+    # device is behind is thrown away, and with "drop_oldest" it is held back
+    # and replaced by any newer frame before a slot frees up. Frames can only
+    # be dropped when drawn with frame(), a bare update_canvas always blocks.
+    def __init__(self, session=DEFAULT_SESSION, max_frames_in_flight=None, frame_policy="block"):
+        super().__init__(session)
+        if frame_policy not in FRAME_POLICIES:
+            raise ValueError("unknown frame policy (%s), must be in (%s)" % (frame_policy, ", ".join(FRAME_POLICIES)))
+        if CONNECTOR_PROCESS is None:
+            run()
+        self._startup_times["connector_start"] = CONNECTOR_STARTUP_TIME
+        self._startup_times["connector_ready"] = time.perf_counter()
+        self.recvq = CONNECTOR_REPLY_ROUTER.queue_for(session)
+        self.sendq = CONNECTOR_API_SEND
+        self.max_frames_in_flight = max_frames_in_flight
+        self.frame_policy = frame_policy
+        self._frames_in_flight = deque()
+        self._queued_frame = None
+        self.frame_stats = {
+            "frames": 0,
+            "dropped_frames": 0,
+            "late_frames": 0
+        }
+
+    def _send(self, msg):
+        self.sendq.put_nowait(msg)
+
+    def _poll(self):
+        while self._pending:
+            try:
+                r = self.recvq.get_nowait()
+            except Empty:
+                break
+            self._dispatch(r)
+        self._reap_frames()
+
+    def _wait_for(self, request_id):
+        while request_id in self._pending:
+            self._dispatch(self.recvq.get())
+
+    def _receive_events(self):
+        # Connector events are only seen once their replies are dispatched,
+        # pick up everything that has arrived
+        while True:
+            try:
+                r = self.recvq.get_nowait()
+            except Empty:
+                break
+            self._dispatch(r)
+
+    def wait_connected(self, timeout=None):
+        # Returns once a device is attached to the session, raises
+        # TimeoutError if none attaches within timeout seconds
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._receive_events()
+        while not self._connected:
+            try:
+                if deadline is None:
+                    r = self.recvq.get()
+                else:
+                    r = self.recvq.get(timeout=max(0, deadline - time.monotonic()))
+            except Empty:
+                raise TimeoutError("no device connected to session %s" % self.session)
+            self._dispatch(r)
+
+    def _call(self, func, args=None, kwargs=None, result=None, wait=True, api="display"):
+        pending = self._prepare(func, args, kwargs, result, api)
+        if pending is None:
+            return None
+        if not wait:
+            # Fire and forget, pick up any replies that have already arrived
+            # so errors are reported at the next sync point
+            self._poll()
+            return pending
+
+        # Replies arrive in order, so once this one is in every earlier call
+        # has finished too and any failures among them are raised first
+        self._wait_for(pending.request_id)
+        self._raise_errors()
+        return pending.result()
+
+    def flush(self):
+        while self._queued_frame is not None:
+            self._wait_for_frame_slot()
+        if self._pending:
+            self._wait_for(max(self._pending))
+        self._reap_frames()
+        self._raise_errors()
+
+    def _reap_frames(self):
+        while self._frames_in_flight and self._frames_in_flight[0].done():
+            self._frames_in_flight.popleft()
+        if self._queued_frame is not None and len(self._frames_in_flight) < self.max_frames_in_flight:
+            commands, binary, changes = self._queued_frame
+            self._queued_frame = None
+            self._send_frame("batch", [commands], {}, binary, changes)
+
+    def _wait_for_frame_slot(self):
+        self._wait_for(self._frames_in_flight[0].request_id)
+        self._reap_frames()
+
+    def _send_frame(self, func, args, kwargs, binary, changes=None):
+        self._binary = binary
+        pending = self._prepare(func, args, kwargs)
+        if changes is not None:
+            # The frame reaches the device, so do its uploads and uniforms
+            digests, uniforms, stats = changes
+            _apply_changes(self._buffer_digests, digests)
+            _apply_changes(self._uniform_cache, uniforms)
+            for name, amount in stats.items():
+                self.upload_stats[name] += amount
+        self._frames_in_flight.append(pending)
+        self.frame_stats['frames'] += 1
+        return pending
+
+    def _submit_frame(self, func, args, kwargs, binary, droppable, changes=None):
+        self._poll()
+        if len(self._frames_in_flight) >= self.max_frames_in_flight:
+            if droppable and self.frame_policy == "drop_newest":
+                self.frame_stats['dropped_frames'] += 1
+                return None
+            if droppable and self.frame_policy == "drop_oldest":
+                if self._queued_frame is not None:
+                    self.frame_stats['dropped_frames'] += 1
+                self._queued_frame = (args[0], binary, changes)
+                return None
+            self.frame_stats['late_frames'] += 1
+            while len(self._frames_in_flight) >= self.max_frames_in_flight:
+                self._wait_for_frame_slot()
+        pending = self._send_frame(func, args, kwargs, binary, changes)
+        self._raise_errors()
+        return pending
+
+    def _present(self, kwargs):
+        if self.max_frames_in_flight is None or self._batch is not None:
+            return super()._present(kwargs)
+        binary, self._binary = self._binary, []
+        return self._submit_frame("update_canvas", [], kwargs, binary, False)
+
+    @contextmanager
+    def frame(self):
+        if self.max_frames_in_flight is None:
+            with super().frame():
+                yield self
+            return
+
+        # The whole frame is recorded so it can be held back or dropped. It
+        # uses the caches as usual, but since it may never be drawn what it
+        # changes in them is set aside and only applied once it is sent
+        droppable = self.frame_policy != "block"
+        self.begin_batch()
+        before = self._batch_caches
+        try:
+            yield self
+            self.update_canvas()
+        except BaseException:
+            self._discard_batch()
+            raise
+        commands = self._end_batch()
+        binary, self._binary = self._binary, []
+        changes = None
+        if droppable:
+            digests, uniforms, stats = self._cache_state()
+            changes = (
+                _dict_changes(before[0], digests),
+                _dict_changes(before[1], uniforms),
+                {name: stats[name] - before[2][name] for name in stats}
+            )
+            self._buffer_digests, self._uniform_cache, self.upload_stats = before
+        return self._submit_frame("batch", [commands], {}, binary, droppable, changes)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Mathew Young
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import time
+import trio
+
+from collections import deque
+from functools import partial
+from trio_websocket import open_websocket_url, ConnectionClosed
+from urllib.parse import quote
+
+from .journal import CREATE_KINDS
+
+# Everything else display_firmware.js understands, answered with no data
+VOID_FUNCS = (
+    "buffer_update_data", "buffer_update_sub_data", "index_buffer_update_data",
+    "program_link_attributes", "program_update_uniforms", "execute_program",
+    "set_gl_viewport", "set_gl_clear_color", "clear", "delete_bundle",
+    "delete_buffer", "delete_index_buffer", "delete_program"
+)
+
+def _response(func, data=None, status=0, status_msg="success"):
+    return {"type": "display", "response": {
+        "func": func,
+        "status": status,
+        "status_msg": status_msg,
+        "data": {} if data is None else data
+    }}
+
+class FakeDevice(object):
+    # Stands in for a browser running display_firmware.js: speaks the same
+    # websocket protocol and answers every command the way the firmware
+    # would, without drawing anything. gl_cost is the simulated time (in
+    # seconds) each command takes, frames are presented refresh_rate times a
+    # second and hold back the commands behind them as the firmware does.
+    def __init__(self, width=600, height=400, refresh_rate=60, gl_cost=0.0):
+        self.width = width
+        self.height = height
+        self.refresh_rate = refresh_rate
+        self.gl_cost = gl_cost
+        self.stats = {"messages": 0, "commands": 0, "received_bytes": 0, "frames": 0}
+        self._reset()
+        self._queue = deque()
+        self._queued = trio.Event()
+        self._lock = trio.Lock()
+        self._ws = None
+
+    def _reset(self):
+        self.next_ids = {}
+        self.bundles = {}
+        self.frame_number = 0
+        self.frame_pending = False
+        self.vsync_waiters = []
+        self.gpu_timing = False
+        self.gpu_timings = []
+        self.gpu_frame = None
+
+    def _next_id(self, kind, kwargs):
+        resource_id = kwargs.get('id', self.next_ids.get(kind, 0))
+        self.next_ids[kind] = max(self.next_ids.get(kind, 0), resource_id + 1)
+        return resource_id
+
+    def handle(self, msg, request_id):
+        func = msg['func']
+        args = msg.get('args', [])
+        kwargs = msg.get('kwargs', {})
+        self.stats['commands'] += 1
+
+        if func == "init_display":
+            self._reset()
+            return _response(func)
+        if func == "get_resolution":
+            return _response(func, {"w": self.width, "h": self.height})
+        if func in CREATE_KINDS:
+            resource_id = self._next_id(CREATE_KINDS[func], kwargs)
+            if func == "record_bundle":
+                self.bundles[resource_id] = args[0]
+            return _response(func, {"id": resource_id})
+        if func == "compile_programs":
+            ids = kwargs.get('ids') or [self._next_id("program", {}) for program in args[0]]
+            for program_id in ids:
+                self._next_id("program", {"id": program_id})
+            return _response(func, {"ids": ids})
+        if func == "batch":
+            responses = [self.handle(cmd, request_id)['response'] for cmd in args[0]]
+            failed = sum(1 for r in responses if r['status'] != 0)
+            return _response(func, {"responses": responses}, 0 if failed == 0 else 1,
+                "success" if failed == 0 else "%d batched command(s) failed" % failed)
+        if func == "play_bundle":
+            if args[0] not in self.bundles:
+                return _response(func, status=1, status_msg="unknown bundle (%s)" % args[0])
+            for cmd in self.bundles[args[0]]:
+                self.handle(cmd, request_id)
+            return _response(func)
+        if func == "update_canvas":
+            if kwargs.get('vsync') is False:
+                self._present()
+            else:
+                self.frame_pending = True
+            return _response(func)
+        if func == "set_gpu_timing":
+            self.gpu_timing = args[0]
+            return _response(func)
+        if func == "gpu_timings":
+            timings, self.gpu_timings = self.gpu_timings, []
+            return _response(func, {"timings": timings, "dropped": 0, "disjoint": 0})
+        if func == "execute_program" and self.gpu_timing:
+            # Every draw takes gl_cost on the simulated GPU
+            self._gpu_time({"kind": "draw", "program": args[0], "frame": self.frame_number + 1, "gpu_ms": self.gl_cost * 1000.0})
+        if func == "wait_for_vsync":
+            # Answered by the refresh loop
+            self.vsync_waiters.append(request_id)
+            return None
+        if func in VOID_FUNCS:
+            return _response(func)
+        return _response(func, status=99, status_msg="Unknown Display API Function (%s) called" % func)
+
+    def _gpu_frame_total(self, frame):
+        if self.gpu_frame is None or self.gpu_frame['frame'] != frame:
+            self.gpu_frame = {"kind": "frame", "frame": frame, "gpu_ms": 0.0, "draws": 0}
+        return self.gpu_frame
+
+    def _gpu_time(self, timing):
+        total = self._gpu_frame_total(timing['frame'])
+        total['gpu_ms'] += timing['gpu_ms']
+        total['draws'] += 1
+        self.gpu_timings.append(timing)
+
+    def _present(self):
+        if self.gpu_timing:
+            # Frames without draws are reported too, as the firmware does
+            self.gpu_timings.append(self._gpu_frame_total(self.frame_number + 1))
+            self.gpu_frame = None
+        self.frame_number += 1
+        self.stats['frames'] += 1
+
+    async def _reply(self, request_id, r):
+        r['id'] = request_id
+        r['frame'] = self.frame_number
+        await self._ws.send_message(json.dumps(r))
+
+    async def _refresh(self):
+        interval = 1.0 / self.refresh_rate
+        while True:
+            await trio.sleep(interval)
+            if self.frame_pending:
+                self._present()
+                self.frame_pending = False
+                # Whatever was queued behind the frame runs before the
+                # waiters are answered, which may be asking for the next one
+                await self._drain()
+            waiters, self.vsync_waiters = self.vsync_waiters, []
+            for request_id in waiters:
+                await self._reply(request_id, _response("wait_for_vsync", {
+                    "frame": self.frame_number,
+                    "timestamp": time.time()
+                }))
+
+    async def _drain(self):
+        async with self._lock:
+            # A submitted frame holds back everything behind it until the
+            # next refresh presents it
+            while self._queue and not self.frame_pending:
+                await self._run(*self._queue.popleft())
+
+    async def _process(self):
+        while True:
+            await self._queued.wait()
+            self._queued = trio.Event()
+            await self._drain()
+
+    async def _run(self, api_json, binary):
+        started = time.perf_counter()
+        commands = self.stats['commands']
+        trace = api_json.get('trace')
+        if trace is not None:
+            trace['receive'] = time.time()
+        r = self.handle(api_json['msg'], api_json.get('id'))
+        # Every command run costs gl_cost, a batch or bundle costs one each
+        if self.gl_cost:
+            await trio.sleep(self.gl_cost * (self.stats['commands'] - commands))
+        if r is not None:
+            r['handler_ms'] = (time.perf_counter() - started) * 1000.0
+            if trace is not None:
+                trace['handled'] = time.time()
+                r['trace'] = trace
+            await self._reply(api_json.get('id'), r)
+
+    async def _receive(self):
+        while True:
+            message = await self._ws.get_message()
+            api_json = json.loads(message)
+            binary = []
+            # Binary payloads follow as their own frames
+            for i in range(api_json.get('binary', 0)):
+                binary.append(await self._ws.get_message())
+            self.stats['messages'] += 1
+            self.stats['received_bytes'] += len(message) + sum(len(payload) for payload in binary)
+            self._queue.append((api_json, binary))
+            self._queued.set()
+
+    async def run(self, url):
+        # Returns when the connector closes the connection
+        async def guarded(task, cancel_scope, *args):
+            try:
+                await task(*args)
+            except ConnectionClosed:
+                cancel_scope.cancel()
+
+        async with open_websocket_url(url) as ws:
+            self._ws = ws
+            async with trio.open_nursery() as n:
+                n.start_soon(guarded, self._refresh, n.cancel_scope)
+                n.start_soon(guarded, self._process, n.cancel_scope)
+                n.start_soon(guarded, self._receive, n.cancel_scope)
+
+async def run_fake_device(host='localhost', port=8088, session="default", retry=True, **options):
+    # Connects to the connector's websocket server, waiting for it to come
+    # up when retry is set
+    # Encoded as connector.js does
+    url = "ws://%s:%d/%s" % (host, port, quote(session, safe=''))
+    device = FakeDevice(**options)
+    while True:
+        try:
+            await device.run(url)
+            return device
+        except OSError:
+            if not retry:
+                raise
+            await trio.sleep(0.1)
+
+def main():
+    parser = argparse.ArgumentParser(description="A headless stand-in for the browser display")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--session", default="default")
+    parser.add_argument("--refresh-rate", type=float, default=60)
+    parser.add_argument("--gl-cost", type=float, default=0.0, help="simulated seconds per command")
+    args = parser.parse_args()
+    trio.run(partial(run_fake_device, args.host, args.port, args.session,
+        refresh_rate=args.refresh_rate, gl_cost=args.gl_cost))
+
+if __name__ == "__main__":
+    main()
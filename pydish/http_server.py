@@ -14,32 +14,259 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gzip
+import hashlib
+import json
+import re
 import trio
 
+from functools import partial
+
 try:
     import importlib.resources as pkg_resources
 except ImportError:
     import importlib_resources as pkg_resources # Try backported to PY<37 `importlib_resources`.
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 from . import static
 
-DEFAULT_PATH_MAP = {
-    "/": pkg_resources.read_text(static, "device.html"),
-    "/connector": pkg_resources.read_text(static, "connector.js"),
-    "/display_firmware": pkg_resources.read_text(static, "display_firmware.js"),
-    # "/keyboard_firmware": pkg_resources.read_text(static, "keyboard_firmware.js"),
-    # "/mouse_firmware": pkg_resources.read_text(static, "mouse_firmware.js")
+STATIC_FILES = {
+    "/": "device.html",
+    "/connector": "connector.js",
+    "/display_firmware": "display_firmware.js",
+    "/display_worker": "display_worker.js",
+    # "/keyboard_firmware": "keyboard_firmware.js",
+    # "/mouse_firmware": "mouse_firmware.js"
 }
 
-async def http_main(path_map=DEFAULT_PATH_MAP):
-    async def http_handler(stream):
-        req = (await stream.receive_some()).decode('utf-8')
-        method, path, proto_version = req.split('\n')[0].split()
-        print(f"GET Request for path {path}")
-        if path_map is None or path not in path_map:
-            await stream.send_all(f"HTTP/1.1 404 Not Found\n\nError Not Found\n".encode('utf-8'))
+# Only read when a server first needs it, not on import
+DEFAULT_PATH_MAP = None
+
+def default_path_map():
+    global DEFAULT_PATH_MAP
+    if DEFAULT_PATH_MAP is None:
+        DEFAULT_PATH_MAP = {
+            path: pkg_resources.read_text(static, filename)
+            for path, filename in STATIC_FILES.items()
+        }
+    return DEFAULT_PATH_MAP
+
+# Everything else in the path map is javascript
+CONTENT_TYPES = {
+    "/": "text/html; charset=utf-8"
+}
+DEFAULT_CONTENT_TYPE = "application/javascript; charset=utf-8"
+
+MAX_HEADER_BYTES = 16384
+# Nothing served takes a body, anything bigger is refused
+MAX_BODY_BYTES = 1 << 20
+KEEP_ALIVE_TIMEOUT = 15
+
+# A blank line ends the headers
+HEADER_END = re.compile(rb"\r?\n\r?\n")
+
+class HTTPError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+class StaticAsset(object):
+    # A response body encoded (and compressed) once up front, every request
+    # for it only picks the variant to send
+    def __init__(self, body, content_type):
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        self.content_type = content_type
+        digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.variants = {"identity": (body, '"%s"' % digest)}
+        compressed = [("gzip", gzip.compress(body, 9))]
+        if brotli is not None:
+            compressed.append(("br", brotli.compress(body)))
+        for encoding, data in compressed:
+            # Each encoding is a different representation, with its own etag
+            if len(data) < len(body):
+                self.variants[encoding] = (data, '"%s-%s"' % (digest, encoding))
+
+    def select(self, accept_encoding):
+        accepted = set()
+        for item in accept_encoding.split(','):
+            coding, _, params = item.strip().partition(';')
+            params = params.replace(' ', '')
+            if coding and params not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                accepted.add(coding.strip().lower())
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and (encoding in accepted or "*" in accepted):
+                return encoding, self.variants[encoding]
+        return "identity", self.variants["identity"]
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as If-None-Match calls for
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+def _parse_request(head):
+    # Lines may end in a bare LF, as RFC 9112 allows
+    lines = [line.rstrip("\r") for line in head.decode('latin-1').split("\n")]
+    parts = lines[0].split()
+    if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+        raise HTTPError("400 Bad Request")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if not sep or not name or name != name.strip():
+            raise HTTPError("400 Bad Request")
+        name = name.lower()
+        # Repeated headers are combined, as a comma separated list
+        headers[name] = headers[name] + ", " + value.strip() if name in headers else value.strip()
+    return parts[0], parts[1], parts[2], headers
+
+def _keep_alive(version, headers):
+    connection = [token.strip().lower() for token in headers.get("connection", "").split(',')]
+    if version == "HTTP/1.0":
+        return "keep-alive" in connection
+    return "close" not in connection
+
+def build_assets(path_map):
+    return {
+        path: StaticAsset(body, CONTENT_TYPES.get(path, DEFAULT_CONTENT_TYPE))
+        for path, body in path_map.items()
+    }
+
+async def http_main(path_map=None, host='0.0.0.0', port=8080, ws_port=8088, metrics=None, *, task_status=trio.TASK_STATUS_IGNORED):
+    # Tells connector.js which port the websocket server is listening on
+    path_map = dict(default_path_map() if path_map is None else path_map)
+    path_map["/connector_config"] = "var PYDISH_CONFIG = %s;" % json.dumps({"ws_port": ws_port})
+    assets = build_assets(path_map)
+
+    async def send_response(stream, status, headers, body=b""):
+        head = "HTTP/1.1 %s\r\n" % status
+        head += "".join("%s: %s\r\n" % header for header in headers)
+        await stream.send_all(head.encode('latin-1') + b"\r\n" + body)
+
+    async def send_error(stream, status, connection):
+        body = ("Error %s\n" % status).encode('latin-1')
+        await send_response(stream, status, [
+            ("Content-Type", "text/plain; charset=utf-8"),
+            ("Content-Length", len(body)),
+            ("Connection", connection)
+        ], body)
+
+    async def respond(stream, method, path, headers, connection):
+        # device.html?session=<name> is still device.html
+        path = path.split('?')[0]
+        if method not in ("GET", "HEAD"):
+            raise HTTPError("405 Method Not Allowed")
+        if path == "/metrics" and metrics is not None:
+            # Generated for every scrape, so never cached
+            body = metrics.prometheus().encode('utf-8')
+            await send_response(stream, "200 OK", [
+                ("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+                ("Content-Length", len(body)),
+                ("Cache-Control", "no-store"),
+                ("Connection", connection)
+            ], b"" if method == "HEAD" else body)
+            return
+        if path not in assets:
+            raise HTTPError("404 Not Found")
+
+        asset = assets[path]
+        encoding, (body, etag) = asset.select(headers.get("accept-encoding", ""))
+        # Clients keep their copy but check it's still current, which costs
+        # an empty 304 while the assets haven't changed
+        response_headers = [
+            ("ETag", etag),
+            ("Cache-Control", "no-cache"),
+            ("Vary", "Accept-Encoding"),
+            ("Connection", connection)
+        ]
+        if _etag_matches(headers.get("if-none-match", ""), etag):
+            await send_response(stream, "304 Not Modified", response_headers)
             return
-        response_body = path_map[path]
-        await stream.send_all(f"HTTP/1.1 200 OK\n\n{response_body}\n".encode('utf-8'))
+        response_headers += [
+            ("Content-Type", asset.content_type),
+            ("Content-Length", len(body))
+        ]
+        if encoding != "identity":
+            response_headers.append(("Content-Encoding", encoding))
+        await send_response(stream, "200 OK", response_headers, b"" if method == "HEAD" else body)
+
+    async def serve_requests(stream):
+        buffer = b""
+        while True:
+            # Read until the end of the headers, giving up on a keep-alive
+            # connection that stays idle
+            end = None
+            with trio.move_on_after(KEEP_ALIVE_TIMEOUT):
+                while end is None:
+                    end = HEADER_END.search(buffer)
+                    if end is not None:
+                        break
+                    if len(buffer) > MAX_HEADER_BYTES:
+                        raise HTTPError("431 Request Header Fields Too Large")
+                    data = await stream.receive_some()
+                    if not data:
+                        return
+                    buffer += data
+            if end is None:
+                return
+            head, buffer = buffer[:end.start()], buffer[end.end():]
+            method, path, version, headers = _parse_request(head)
+
+            # Any request body is thrown away as it arrives
+            if "transfer-encoding" in headers:
+                raise HTTPError("501 Not Implemented")
+            try:
+                body_length = int(headers.get("content-length", 0))
+            except ValueError:
+                raise HTTPError("400 Bad Request")
+            if body_length < 0:
+                raise HTTPError("400 Bad Request")
+            if body_length > MAX_BODY_BYTES:
+                raise HTTPError("413 Content Too Large")
+            remaining = body_length - min(body_length, len(buffer))
+            buffer = buffer[body_length:]
+            with trio.move_on_after(KEEP_ALIVE_TIMEOUT):
+                while remaining > 0:
+                    data = await stream.receive_some()
+                    if not data:
+                        return
+                    # Whatever follows the body is the next request
+                    buffer = data[remaining:]
+                    remaining -= min(remaining, len(data))
+            if remaining > 0:
+                return
+
+            keep_alive = _keep_alive(version, headers)
+            connection = "keep-alive" if keep_alive else "close"
+            try:
+                await respond(stream, method, path, headers, connection)
+            except HTTPError as e:
+                await send_error(stream, e.status, connection)
+            if not keep_alive:
+                return
+
+    async def http_handler(stream):
+        try:
+            try:
+                await serve_requests(stream)
+            except HTTPError as e:
+                # The request couldn't be parsed, so the connection can't be reused
+                await send_error(stream, e.status, "close")
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            pass
+        finally:
+            await stream.aclose()
+
     async with trio.open_nursery() as n:
-            n.start_soon(trio.serve_tcp, http_handler, 8080)
\ No newline at end of file
+        listeners = await n.start(partial(trio.serve_tcp, http_handler, port, host=host))
+        task_status.started(listeners)
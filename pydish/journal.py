@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Mathew Young
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from array import array
+
+# Replies to the replayed journal carry this id, it's never a Display request id
+RESTORE_ID = "restore"
+
+# The commands creating each kind of resource, the connector picks their ids
+CREATE_KINDS = {
+    "compile_vertex_shader": "vertex_shader",
+    "compile_fragment_shader": "fragment_shader",
+    "create_program": "program",
+    "create_buffer": "buffer",
+    "create_index_buffer": "index_buffer",
+    "record_bundle": "bundle"
+}
+
+def _map_binary(obj, remap):
+    # Copy of a command with every {"binary": i} reference passed through remap
+    if isinstance(obj, dict):
+        if len(obj) == 1 and 'binary' in obj:
+            return {"binary": remap(obj['binary'])}
+        return {key: _map_binary(value, remap) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_map_binary(value, remap) for value in obj]
+    return obj
+
+def _float32_payload(data):
+    # Json lists are float32 on the device, keep them as the bytes it holds
+    if isinstance(data, dict):
+        return None
+    return bytearray(array('f', data).tobytes())
+
+class Journal(object):
+    # Everything a session's device needs to get back to its current state:
+    # the live resources and the last value of anything set on them. Entries
+    # are keyed by what they set, so a newer command replaces the one it
+    # supersedes and the journal only grows with the live state.
+    def __init__(self):
+        self.entries = {}
+        self.next_ids = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _next_id(self, kind):
+        next_id = self.next_ids.get(kind, 0)
+        self.next_ids[kind] = next_id + 1
+        return next_id
+
+    def assign_ids(self, cmd):
+        func = cmd['func']
+        if func == "batch":
+            for sub_cmd in cmd['args'][0]:
+                self.assign_ids(sub_cmd)
+        elif func == "compile_programs":
+            if 'ids' not in cmd['kwargs']:
+                cmd['kwargs']['ids'] = [self._next_id("program") for program in cmd['args'][0]]
+        elif func in CREATE_KINDS:
+            if 'id' not in cmd['kwargs']:
+                cmd['kwargs']['id'] = self._next_id(CREATE_KINDS[func])
+
+    def _put(self, key, request_id, cmd, binary):
+        # Superseded entries are dropped and the new one goes to the end, after
+        # everything it can depend on
+        self.entries.pop(key, None)
+        self.entries[key] = (request_id, cmd, binary)
+
+    def _drop(self, match):
+        for key in [key for key in self.entries if match(key)]:
+            del self.entries[key]
+
+    def record(self, request_id, cmd, binary):
+        func = cmd['func']
+        if func == "batch":
+            for sub_cmd in cmd['args'][0]:
+                self.record(request_id, sub_cmd, binary)
+            return
+
+        # Each entry keeps its own copy of the payloads it references
+        payloads = []
+        def remap(index):
+            payloads.append(binary[index])
+            return len(payloads) - 1
+        cmd = _map_binary(cmd, remap)
+        args = cmd['args']
+
+        if func == "init_display":
+            # The device starts again from nothing
+            self.entries.clear()
+            self._put(("init",), request_id, cmd, payloads)
+        elif func == "set_gl_viewport":
+            self._put(("viewport",), request_id, cmd, payloads)
+        elif func == "set_gl_clear_color":
+            self._put(("clear_color",), request_id, cmd, payloads)
+        elif func == "set_gpu_timing":
+            self._put(("gpu_timing",), request_id, cmd, payloads)
+        elif func == "compile_programs":
+            # Split up so each program can be deleted on its own, a replay is
+            # a batch and can't wait for a parallel compile
+            for program, program_id in zip(args[0], cmd['kwargs']['ids']):
+                self._put(("program", program_id), request_id, {
+                    "func": func,
+                    "args": [[program]],
+                    "kwargs": {"ids": [program_id], "parallel": False}
+                }, [])
+        elif func in CREATE_KINDS:
+            self._put((CREATE_KINDS[func], cmd['kwargs']['id']), request_id, cmd, payloads)
+        elif func == "buffer_update_data":
+            data = payloads[0] if payloads else _float32_payload(args[1])
+            self._put(("buffer_data", args[0]), request_id, {
+                "func": func,
+                "args": [args[0], {"binary": 0}],
+                "kwargs": cmd['kwargs']
+            }, [bytearray(data)])
+        elif func == "buffer_update_sub_data":
+            # Patched into the journalled contents of the buffer, an update
+            # outside of the buffer was rejected by the device too
+            entry = self.entries.get(("buffer_data", args[0]))
+            data = payloads[0] if payloads else _float32_payload(args[2])
+            if entry is not None and data is not None and args[1] + len(data) <= len(entry[2][0]):
+                entry[2][0][args[1]:args[1] + len(data)] = data
+        elif func == "index_buffer_update_data":
+            self._put(("index_buffer_data", args[0]), request_id, cmd, payloads)
+        elif func == "program_link_attributes":
+            for name, link in args[1].items():
+                self._put(("link", args[0], name), request_id, {
+                    "func": func,
+                    "args": [args[0], {name: link}],
+                    "kwargs": cmd['kwargs']
+                }, [])
+        elif func == "program_update_uniforms":
+            for name, value in args[1].items():
+                self._put(("uniform", args[0], name), request_id, {
+                    "func": func,
+                    "args": [args[0], {name: value}],
+                    "kwargs": cmd['kwargs']
+                }, [])
+        elif func == "delete_buffer":
+            self._drop(lambda key: key in (("buffer", args[0]), ("buffer_data", args[0])))
+        elif func == "delete_index_buffer":
+            self._drop(lambda key: key in (("index_buffer", args[0]), ("index_buffer_data", args[0])))
+        elif func == "delete_program":
+            self._drop(lambda key: key[0] in ("program", "link", "uniform") and key[1] == args[0])
+        elif func == "delete_bundle":
+            self._drop(lambda key: key == ("bundle", args[0]))
+
+    def replay(self, skip=()):
+        # One batch recreating the journalled state, leaving out the entries
+        # from request ids in skip (those are sent again as they were)
+        commands = []
+        binary = []
+        for request_id, cmd, payloads in self.entries.values():
+            if request_id in skip:
+                continue
+            offset = len(binary)
+            binary.extend(bytes(payload) for payload in payloads)
+            commands.append(_map_binary(cmd, lambda index: index + offset))
+        if not commands:
+            return None
+        return {
+            "api": "display",
+            "id": RESTORE_ID,
+            "msg": {"func": "batch", "args": [commands], "kwargs": {}},
+            "binary": binary
+        }
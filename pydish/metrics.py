@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Mathew Young
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket plus one for everything above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels)
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metrics(object):
+    # Counters, gauges and histograms keyed by name and labels. Updating one
+    # is a dict lookup and an add, collectors are only run when the metrics
+    # are read, for values that are cheaper to sample than to track.
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, _labels(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def _collect(self):
+        for collector in self.collectors:
+            collector(self)
+
+    def snapshot(self):
+        # Plain dicts and lists, so it can be sent back to a Display as json
+        self._collect()
+        snapshot = {"counters": {}, "gauges": {}, "histograms": {}}
+        for kind in ("counters", "gauges"):
+            for (name, labels), value in sorted(getattr(self, kind).items()):
+                snapshot[kind].setdefault(name, []).append({"labels": dict(labels), "value": value})
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            snapshot["histograms"].setdefault(name, []).append({
+                "labels": dict(labels),
+                "count": histogram.count,
+                "sum": histogram.sum,
+                "buckets": [[_format_value(bound), count] for bound, count in histogram.cumulative()]
+            })
+        return snapshot
+
+    def prometheus(self):
+        # The Prometheus text exposition format
+        self._collect()
+        lines = []
+        for kind, metric_type in (("counters", "counter"), ("gauges", "gauge")):
+            last_name = None
+            for (name, labels), value in sorted(getattr(self, kind).items()):
+                if name != last_name:
+                    lines.append("# TYPE %s %s" % (name, metric_type))
+                    last_name = name
+                lines.append("%s%s %s" % (name, _format_labels(labels), _format_value(value)))
+        last_name = None
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name != last_name:
+                lines.append("# TYPE %s histogram" % name)
+                last_name = name
+            for bound, count in histogram.cumulative():
+                lines.append("%s_bucket%s %d" % (name, _format_labels(labels, [("le", _format_value(bound))]), count))
+            lines.append("%s_sum%s %s" % (name, _format_labels(labels), _format_value(histogram.sum)))
+            lines.append("%s_count%s %d" % (name, _format_labels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Mathew Young
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import struct
+import threading
+import time
+
+from multiprocessing import Event
+from multiprocessing import shared_memory
+from queue import Empty, Full
+
+# head and tail are running byte counts, their difference is the amount of
+# unread data and each modulo the ring size is the position in the ring
+HEADER = struct.Struct('<QQ')
+# total record length, json length, binary payload count (-1 for none)
+RECORD = struct.Struct('<IIi')
+LENGTH = struct.Struct('<I')
+
+DEFAULT_RING_SIZE = 1 << 24
+
+class RingQueue(object):
+    # Single producer, single consumer ring of length prefixed records in
+    # shared memory. A record is the json encoded message followed by its
+    # binary payloads (the 'binary' list of a display message), which are
+    # copied into the ring once by the writer and once out by the reader.
+    # The head/tail counters are only ever written by one side each, so no
+    # lock is shared between processes; the events are just doorbells to
+    # wake a reader waiting for data or a writer waiting for space.
+    def __init__(self, size=DEFAULT_RING_SIZE):
+        self.size = size
+        self._shm = shared_memory.SharedMemory(create=True, size=HEADER.size + size)
+        HEADER.pack_into(self._shm.buf, 0, 0, 0)
+        self._data_ready = Event()
+        self._space_ready = Event()
+        self._owner = True
+        self._init_local()
+
+    def _init_local(self):
+        self._buf = self._shm.buf
+        # Several threads in one process may share an end of the ring
+        self._put_lock = threading.Lock()
+        self._get_lock = threading.Lock()
+
+    def __getstate__(self):
+        return (self._shm.name, self.size, self._data_ready, self._space_ready)
+
+    def __setstate__(self, state):
+        name, self.size, self._data_ready, self._space_ready = state
+        self._shm = shared_memory.SharedMemory(name=name)
+        self._owner = False
+        self._init_local()
+
+    def _counters(self):
+        return HEADER.unpack_from(self._buf, 0)
+
+    def _write(self, pos, data):
+        data = memoryview(data).cast('B')
+        start = HEADER.size + pos % self.size
+        first = min(len(data), HEADER.size + self.size - start)
+        self._buf[start:start + first] = data[:first]
+        if first < len(data):
+            self._buf[HEADER.size:HEADER.size + len(data) - first] = data[first:]
+        return pos + len(data)
+
+    def _read(self, pos, length):
+        start = HEADER.size + pos % self.size
+        first = min(length, HEADER.size + self.size - start)
+        if first == length:
+            return bytes(self._buf[start:start + length])
+        return bytes(self._buf[start:start + first]) + bytes(self._buf[HEADER.size:HEADER.size + length - first])
+
+    def _wait(self, event, ready, deadline, exc):
+        while not ready():
+            event.clear()
+            if ready():
+                return
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if (timeout is not None and timeout <= 0) or not event.wait(timeout):
+                raise exc
+
+    def put(self, msg, block=True, timeout=None):
+        binary = msg.get('binary')
+        if binary is not None:
+            msg = dict(msg)
+            del msg['binary']
+        header = json.dumps(msg).encode('utf-8')
+        length = RECORD.size + len(header)
+        if binary is not None:
+            length += sum(LENGTH.size + memoryview(payload).nbytes for payload in binary)
+        if length > self.size:
+            raise ValueError("message of %d bytes does not fit in a ring of %d bytes" % (length, self.size))
+
+        with self._put_lock:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            if not block:
+                deadline = time.monotonic()
+            head, _ = self._counters()
+            self._wait(self._space_ready, lambda: self.size - (head - self._counters()[1]) >= length, deadline, Full)
+
+            pos = self._write(head, RECORD.pack(length, len(header), -1 if binary is None else len(binary)))
+            pos = self._write(pos, header)
+            for payload in binary or ():
+                pos = self._write(pos, LENGTH.pack(memoryview(payload).nbytes))
+                pos = self._write(pos, payload)
+            # Publish the record only once all of it is in the ring
+            struct.pack_into('<Q', self._buf, 0, head + length)
+        self._data_ready.set()
+
+    # The ring is bounded, so unlike a Queue this waits for space when full
+    put_nowait = put
+
+    def get(self, block=True, timeout=None):
+        with self._get_lock:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            if not block:
+                deadline = time.monotonic()
+            _, tail = self._counters()
+            self._wait(self._data_ready, lambda: self._counters()[0] != tail, deadline, Empty)
+
+            length, header_length, count = RECORD.unpack(self._read(tail, RECORD.size))
+            pos = tail + RECORD.size
+            msg = json.loads(self._read(pos, header_length))
+            pos += header_length
+            if count >= 0:
+                binary = []
+                for _ in range(count):
+                    payload_length, = LENGTH.unpack(self._read(pos, LENGTH.size))
+                    pos += LENGTH.size
+                    binary.append(self._read(pos, payload_length))
+                    pos += payload_length
+                msg['binary'] = binary
+            struct.pack_into('<Q', self._buf, 8, tail + length)
+        self._space_ready.set()
+        return msg
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def empty(self):
+        head, tail = self._counters()
+        return head == tail
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
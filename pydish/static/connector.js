@@ -12,16 +12,38 @@
 // See the License for the specific language governing permissions and
 // limitations under the License.
 
-var setup_connector = function () {
-    var ws = new WebSocket("ws://localhost:8088");
-    var state = {};
+var setup_connector = function (session, hostname, offscreen_canvas) {
+    // Sessions are selected with the websocket path
+    var ws = new WebSocket("ws://" + hostname + ":" + PYDISH_CONFIG.ws_port + "/" + encodeURIComponent(session));
+    ws.binaryType = "arraybuffer";
+    // With an OffscreenCanvas the firmware renders and presents straight into
+    // it, otherwise it uses the page's canvas
+    var state = {offscreen_canvas: offscreen_canvas};
+    var waiting = null;
+    var queue = [];
 
-    var message_handler = function (event) {
-        // console.log(event.data)
-
-        api_json = JSON.parse(event.data);
+    var run_message = function (api_json, binary) {
+        var started = performance.now();
+        state.binary = binary;
+        state.request_id = api_json.id;
+        // Traced commands record when they arrived and every handler span
+        state.trace_spans = api_json.trace ? [] : null;
+        if (api_json.trace) {
+            api_json.trace.receive = util_trace_time(started);
+        }
         if (api_json.api == "display") {
-            r = api_display_handle(state, api_json.msg);
+            // A command that throws still gets a reply, or its caller would
+            // wait for it forever
+            try {
+                r = api_display_handle(state, api_json.msg);
+            } catch (e) {
+                r = {type: "display", response: {
+                    func: api_json.msg.func,
+                    status: 1,
+                    status_msg: "" + e,
+                    data: {}
+                }};
+            }
         }
         else
         {
@@ -33,10 +55,83 @@ var setup_connector = function () {
             }};
         }
 
+        // Deferred calls (e.g. wait_for_vsync) reply later through state.reply
+        if (r != null) {
+            // How long the firmware took, for the connector's metrics
+            r.handler_ms = performance.now() - started;
+            if (api_json.trace) {
+                api_json.trace.handled = util_trace_time(performance.now());
+                api_json.trace.spans = state.trace_spans;
+                r.trace = api_json.trace;
+            }
+            state.reply(api_json.id, r);
+        }
+    };
+
+    var process_queue = function () {
+        // A submitted frame holds back the commands behind it until it has
+        // been presented, so they can't draw over it, and programs still
+        // compiling hold back the commands that may use them
+        while (queue.length > 0 && !state.frame_pending && !state.compiling) {
+            var m = queue.shift();
+            run_message(m.api_json, m.binary);
+        }
+    };
+
+    state.reply = function (id, r) {
+        // Echo the request id so replies can be matched to pipelined calls
+        r.id = id;
+        // Frames presented so far, the connector works out the frame rate
+        r.frame = state.frame_number || 0;
+
         // console.log("Sending "+r.type);
         ws.send(JSON.stringify(r));
     };
+    state.resume = process_queue;
+
+    var message_handler = function (event) {
+        // console.log(event.data)
+
+        // Binary payloads arrive as separate frames straight after the json
+        // message that references them
+        if (event.data instanceof ArrayBuffer) {
+            waiting.binary.push(event.data);
+            if (waiting.binary.length < waiting.api_json.binary) {
+                return;
+            }
+            queue.push(waiting);
+            waiting = null;
+        }
+        else
+        {
+            var api_json = JSON.parse(event.data);
+            if (api_json.binary > 0) {
+                waiting = {api_json: api_json, binary: []};
+                return;
+            }
+            queue.push({api_json: api_json, binary: []});
+        }
+        process_queue();
+    };
     ws.onmessage = message_handler;
 };
 
-setup_connector();
\ No newline at end of file
+// In a worker (display_worker.js) the page hands over the canvas and the
+// worker calls setup_connector itself
+if (typeof window !== "undefined") {
+    // The page is opened as device.html?session=<name> to drive a particular
+    // Display, worker=0 keeps all of the firmware on the page's main thread
+    var params = new URLSearchParams(window.location.search);
+    var session = params.get("session") || "default";
+    var canvas = window.document.getElementById("canvas_output_ctx");
+
+    if (params.get("worker") != "0" && typeof Worker !== "undefined" && canvas.transferControlToOffscreen) {
+        var offscreen = canvas.transferControlToOffscreen();
+        var worker = new Worker("display_worker");
+        worker.postMessage({session: session, hostname: window.location.hostname, canvas: offscreen}, [offscreen]);
+    }
+    else
+    {
+        setup_connector(session, window.location.hostname, null);
+    }
+}
\ No newline at end of file
@@ -29,6 +29,23 @@ var util_create_shader = function (gl, type, source) {
     return [null, err_msg];
 };
 
+var util_resource_id = function (kwargs, next_id) {
+    // The connector gives new resources explicit ids, so that after a reload
+    // they can be created again with the ids the app already holds
+    if (kwargs && kwargs.id !== undefined) {
+        return kwargs.id;
+    }
+    return next_id;
+};
+
+var util_resolve_data = function (state, data) {
+    // Replace a reference to a binary frame with the ArrayBuffer itself
+    if (data != null && data.binary !== undefined) {
+        return state.binary[data.binary];
+    }
+    return data;
+};
+
 var api_display_compile_vertex_shader = function (state, args, kwargs) {
     var code = args[0];
     const [shader, err] = util_create_shader(state.gl, state.gl.VERTEX_SHADER, code);
@@ -41,8 +58,8 @@ var api_display_compile_vertex_shader = function (state, args, kwargs) {
         }};
     }
 
-    var index = state.vertex_shaders.length;
-    state.vertex_shaders.push(shader);
+    var index = util_resource_id(kwargs, state.vertex_shaders.length);
+    state.vertex_shaders[index] = shader;
 
     return {type: "display", response: {
         func: "compile_vertex_shader",
@@ -66,8 +83,8 @@ var api_display_compile_fragment_shader = function (state, args, kwargs) {
         }};
     }
 
-    var index = state.fragment_shaders.length;
-    state.fragment_shaders.push(shader);
+    var index = util_resource_id(kwargs, state.fragment_shaders.length);
+    state.fragment_shaders[index] = shader;
 
     return {type: "display", response: {
         func: "compile_fragment_shader",
@@ -96,40 +113,8 @@ var api_display_create_program = function (state, args, kwargs) {
 
     var success = state.gl.getProgramParameter(program, state.gl.LINK_STATUS);
     if (success) {
-        // Create a vertex array for the program
-        var vao = state.gl.createVertexArray();
+        var index = util_register_program(state, program, uniforms, attributes, util_resource_id(kwargs, state.programs.length));
 
-        var index = state.programs.length;
-        state.programs.push({
-            glid: program,
-            uniforms: uniforms,
-            attributes: attributes,
-            vao: vao
-        });
-
-        for (var u_name in state.programs[index].uniforms) {
-            var u = state.programs[index].uniforms[u_name];
-
-            u.loc = state.gl.getUniformLocation(program, u_name);
-        }
-
-        // Bind the vertex array object as we're about to update it
-        state.gl.bindVertexArray(vao);
-        for (var a_name in state.programs[index].attributes) {
-            var a = state.programs[index].attributes[a_name];
-
-            // Get the location for the attribute
-            a.loc = state.gl.getAttribLocation(program, a_name);
-            // Enable the attribute
-            state.gl.enableVertexAttribArray(a.loc);
-            // Create a buffer for the attribute
-            // a.buffer = state.gl.createBuffer();
-            // Bind the buffer, to link against the attribute
-            // state.gl.bindBuffer(state.gl.ARRAY_BUFFER, a.buffer);
-            // Update the vertex array object for the current attribute, linking it to the new buffer
-            // state.gl.vertexAttribPointer(a.loc, a.size, state.gl.FLOAT, false, 0, 0);
-        }
-        
         return {type: "display", response: {
             func: "create_program",
             status: 0,
@@ -152,14 +137,145 @@ var api_display_create_program = function (state, args, kwargs) {
     }};
 }
 
+var util_register_program = function (state, program, uniforms, attributes, index) {
+    // Create a vertex array for the program
+    var vao = state.gl.createVertexArray();
+
+    state.programs[index] = {
+        glid: program,
+        uniforms: uniforms,
+        attributes: attributes,
+        vao: vao
+    };
+
+    for (var u_name in state.programs[index].uniforms) {
+        var u = state.programs[index].uniforms[u_name];
+
+        u.loc = state.gl.getUniformLocation(program, u_name);
+    }
+
+    // Bind the vertex array object as we're about to update it
+    state.gl.bindVertexArray(vao);
+    for (var a_name in state.programs[index].attributes) {
+        var a = state.programs[index].attributes[a_name];
+
+        // Get the location for the attribute
+        a.loc = state.gl.getAttribLocation(program, a_name);
+        // Enable the attribute
+        state.gl.enableVertexAttribArray(a.loc);
+        // Create a buffer for the attribute
+        // a.buffer = state.gl.createBuffer();
+        // Bind the buffer, to link against the attribute
+        // state.gl.bindBuffer(state.gl.ARRAY_BUFFER, a.buffer);
+        // Update the vertex array object for the current attribute, linking it to the new buffer
+        // state.gl.vertexAttribPointer(a.loc, a.size, state.gl.FLOAT, false, 0, 0);
+    }
+
+    return index;
+};
+
+var util_compile_programs_done = function (state, compiling, kwargs) {
+    var ids = [];
+    var errors = [];
+
+    for (var i = 0; i < compiling.length; i++) {
+        var c = compiling[i];
+        var err_msg = null;
+
+        // Only now are the statuses read, so the driver has been free to
+        // compile and link everything before anything waits on it
+        if (!state.gl.getShaderParameter(c.vertex_shader, state.gl.COMPILE_STATUS)) {
+            err_msg = "vertex shader: " + state.gl.getShaderInfoLog(c.vertex_shader);
+        }
+        else if (!state.gl.getShaderParameter(c.fragment_shader, state.gl.COMPILE_STATUS)) {
+            err_msg = "fragment shader: " + state.gl.getShaderInfoLog(c.fragment_shader);
+        }
+        else if (!state.gl.getProgramParameter(c.program, state.gl.LINK_STATUS)) {
+            err_msg = state.gl.getProgramInfoLog(c.program);
+        }
+
+        state.gl.deleteShader(c.vertex_shader);
+        state.gl.deleteShader(c.fragment_shader);
+        if (err_msg == null) {
+            var index = kwargs.ids ? kwargs.ids[i] : state.programs.length;
+            ids.push(util_register_program(state, c.program, c.uniforms, c.attributes, index));
+        }
+        else
+        {
+            console.error(err_msg);
+            state.gl.deleteProgram(c.program);
+            ids.push(null);
+            errors.push("program " + i + ": " + err_msg);
+        }
+    }
+
+    return {type: "display", response: {
+        func: "compile_programs",
+        status: errors.length == 0 ? 0 : 1,
+        status_msg: errors.length == 0 ? "success" : errors.join("\n"),
+        data: {
+            ids: ids
+        }
+    }};
+};
+
+var api_display_compile_programs = function (state, args, kwargs) {
+    var programs = args[0];
+    var compiling = [];
+
+    // Start every compile, then every link, without checking any status
+    for (var i = 0; i < programs.length; i++) {
+        var c = {
+            vertex_shader: state.gl.createShader(state.gl.VERTEX_SHADER),
+            fragment_shader: state.gl.createShader(state.gl.FRAGMENT_SHADER),
+            program: state.gl.createProgram(),
+            uniforms: programs[i].uniforms || {},
+            attributes: programs[i].attributes || {}
+        };
+        state.gl.shaderSource(c.vertex_shader, programs[i].vertex);
+        state.gl.compileShader(c.vertex_shader);
+        state.gl.shaderSource(c.fragment_shader, programs[i].fragment);
+        state.gl.compileShader(c.fragment_shader);
+        compiling.push(c);
+    }
+    for (var i = 0; i < compiling.length; i++) {
+        state.gl.attachShader(compiling[i].program, compiling[i].vertex_shader);
+        state.gl.attachShader(compiling[i].program, compiling[i].fragment_shader);
+        state.gl.linkProgram(compiling[i].program);
+    }
+
+    // parallel=false (e.g. when replayed in a batch) waits for the results
+    if (!state.parallel_compile || kwargs.parallel === false) {
+        return util_compile_programs_done(state, compiling, kwargs);
+    }
+
+    // With KHR_parallel_shader_compile the links are polled once per
+    // animation frame, and the commands behind this one wait until they finish
+    var request_id = state.request_id;
+    var poll = function () {
+        for (var i = 0; i < compiling.length; i++) {
+            if (!state.gl.getProgramParameter(compiling[i].program, state.parallel_compile.COMPLETION_STATUS_KHR)) {
+                requestAnimationFrame(poll);
+                return;
+            }
+        }
+        state.compiling = false;
+        state.reply(request_id, util_compile_programs_done(state, compiling, kwargs));
+        state.resume();
+    };
+    state.compiling = true;
+    requestAnimationFrame(poll);
+    return null;
+};
+
 var api_display_create_buffer = function (state, args, kwargs) {
     var buff = state.gl.createBuffer();
-    var buff_id = state.new_buff_id;
-    state.new_buff_id += 1;
+    var buff_id = util_resource_id(kwargs, state.new_buff_id);
+    state.new_buff_id = Math.max(state.new_buff_id, buff_id + 1);
 
     state.array_buffers[buff_id] = {
         buff: buff,
-        size: 0
+        bytes: 0
     };
 
     return {type: 'display', response: {
@@ -175,12 +291,16 @@ var api_display_create_buffer = function (state, args, kwargs) {
 var api_display_buffer_update_data = function (state, args, kwargs) {
     var buff_index = args[0];
     var buff = state.array_buffers[buff_index];
-    var data = args[1];
+    var data = util_resolve_data(state, args[1]);
 
     state.gl.bindBuffer(state.gl.ARRAY_BUFFER, buff.buff);
-    state.gl.bufferData(state.gl.ARRAY_BUFFER, new Float32Array(data), state.gl.STATIC_DRAW);
-
-    buff.size = data.length;
+    // Binary data is already packed in the attributes' formats and is
+    // uploaded without any conversion, json lists are float32
+    if (!(data instanceof ArrayBuffer)) {
+        data = new Float32Array(data);
+    }
+    state.gl.bufferData(state.gl.ARRAY_BUFFER, data, state.gl.STATIC_DRAW);
+    buff.bytes = data.byteLength;
 
     return {type: "display", response: {
         func: "buffer_update_data",
@@ -190,6 +310,134 @@ var api_display_buffer_update_data = function (state, args, kwargs) {
     }};
 };
 
+var api_display_buffer_update_sub_data = function (state, args, kwargs) {
+    var buff_index = args[0];
+    var buff = state.array_buffers[buff_index];
+    var offset = args[1];
+    var data = util_resolve_data(state, args[2]);
+
+    if (!(data instanceof ArrayBuffer)) {
+        data = new Float32Array(data);
+    }
+    if (offset + data.byteLength > buff.bytes) {
+        return {type: "display", response: {
+            func: "buffer_update_sub_data",
+            status: 1,
+            status_msg: "sub data update is outside of the buffer, use buffer_update_data to resize it",
+            data: {}
+        }};
+    }
+
+    state.gl.bindBuffer(state.gl.ARRAY_BUFFER, buff.buff);
+    state.gl.bufferSubData(state.gl.ARRAY_BUFFER, offset, data);
+
+    return {type: "display", response: {
+        func: "buffer_update_sub_data",
+        status: 0,
+        status_msg: "success",
+        data: {}
+    }};
+};
+
+var api_display_create_index_buffer = function (state, args, kwargs) {
+    var index_type = args[0];
+    var gl_type = null;
+    switch (index_type) {
+        case "uint16":
+            gl_type = state.gl.UNSIGNED_SHORT;
+            break;
+        case "uint32":
+            gl_type = state.gl.UNSIGNED_INT;
+            break;
+        default:
+            return {type: "display", response: {
+                func: "create_index_buffer",
+                status: 1,
+                status_msg: "unknown index type, must be in (uint16, uint32)",
+                data: {}
+            }};
+    }
+
+    var buff = state.gl.createBuffer();
+    var buff_id = util_resource_id(kwargs, state.new_index_buff_id);
+    state.new_index_buff_id = Math.max(state.new_index_buff_id, buff_id + 1);
+
+    state.index_buffers[buff_id] = {
+        buff: buff,
+        type: gl_type,
+        bytes_per_index: (gl_type == state.gl.UNSIGNED_SHORT) ? 2 : 4,
+        size: 0
+    };
+
+    return {type: 'display', response: {
+        func: "create_index_buffer",
+        status: 0,
+        status_msg: "success",
+        data: {
+            id: buff_id
+        }
+    }};
+};
+
+var api_display_index_buffer_update_data = function (state, args, kwargs) {
+    var buff_index = args[0];
+    var buff = state.index_buffers[buff_index];
+    var data = util_resolve_data(state, args[1]);
+
+    if (!(data instanceof ArrayBuffer)) {
+        data = (buff.bytes_per_index == 2) ? new Uint16Array(data) : new Uint32Array(data);
+    }
+
+    // The element array binding is part of the vertex array state, make sure
+    // uploading doesn't change whichever program's vertex array is bound
+    state.gl.bindVertexArray(null);
+    state.gl.bindBuffer(state.gl.ELEMENT_ARRAY_BUFFER, buff.buff);
+    state.gl.bufferData(state.gl.ELEMENT_ARRAY_BUFFER, data, state.gl.STATIC_DRAW);
+
+    buff.size = data.byteLength / buff.bytes_per_index;
+
+    return {type: "display", response: {
+        func: "index_buffer_update_data",
+        status: 0,
+        status_msg: "success",
+        data: {}
+    }};
+};
+
+var util_attribute_type = function (state, attribute_type) {
+    // The gl type and its size in bytes
+    switch (attribute_type) {
+        case "float32":
+            return [state.gl.FLOAT, 4];
+        case "float16":
+            return [state.gl.HALF_FLOAT, 2];
+        case "int8":
+            return [state.gl.BYTE, 1];
+        case "uint8":
+            return [state.gl.UNSIGNED_BYTE, 1];
+        case "int16":
+            return [state.gl.SHORT, 2];
+        case "uint16":
+            return [state.gl.UNSIGNED_SHORT, 2];
+        case "int32":
+            return [state.gl.INT, 4];
+        case "uint32":
+            return [state.gl.UNSIGNED_INT, 4];
+    }
+    return [null, 0];
+};
+
+var util_attribute_option = function (link, a, name, fallback) {
+    // The layout given when linking overrides the one declared with the program
+    if (link[name] !== undefined) {
+        return link[name];
+    }
+    if (a[name] !== undefined) {
+        return a[name];
+    }
+    return fallback;
+};
+
 var api_display_program_link_attributes = function (state, args, kwargs) {
     var program_index = args[0];
     var program = state.programs[program_index];
@@ -201,14 +449,39 @@ var api_display_program_link_attributes = function (state, args, kwargs) {
     state.gl.bindVertexArray(program.vao);
     for (var a_name in attribute_buffers) {
         var a = program.attributes[a_name];
-        var buff = state.array_buffers[attribute_buffers[a_name]];
-        
+        // Either a buffer id, or {buffer, type, normalized, stride, offset}
+        // so several attributes can be interleaved in one buffer
+        var link = attribute_buffers[a_name];
+        if (typeof link !== "object") {
+            link = {buffer: link};
+        }
+        var buff = state.array_buffers[link.buffer];
+        var attribute_type = util_attribute_option(link, a, "type", "float32");
+        const [gl_type, type_bytes] = util_attribute_type(state, attribute_type);
+        if (gl_type == null) {
+            return {type: "display", response: {
+                func: "program_link_attributes",
+                status: 1,
+                status_msg: "unknown attribute type (" + attribute_type + ") for " + a_name,
+                data: {}
+            }};
+        }
+
         a.buffer = buff;
+        // Kept to work out how many vertices the buffer holds
+        a.element_bytes = a.size * type_bytes;
+        a.offset_bytes = util_attribute_option(link, a, "offset", 0);
+        a.stride_bytes = util_attribute_option(link, a, "stride", 0) || a.element_bytes;
 
         // Bind the buffer, to link against the attribute
         state.gl.bindBuffer(state.gl.ARRAY_BUFFER, a.buffer.buff);
         // Update the vertex array object for the current attribute, linking it to the new buffer
-        state.gl.vertexAttribPointer(a.loc, a.size, state.gl.FLOAT, false, 0, 0);
+        state.gl.vertexAttribPointer(a.loc, a.size, gl_type,
+            util_attribute_option(link, a, "normalized", false),
+            util_attribute_option(link, a, "stride", 0),
+            a.offset_bytes);
+        // Attributes with a divisor advance once per instance (or every n instances) instead of per vertex
+        state.gl.vertexAttribDivisor(a.loc, a.divisor || 0);
     }
 
     return {type: "display", response: {
@@ -293,9 +566,16 @@ var api_display_execute_program = function (state, args, kwargs) {
             }};
     }
 
+    var instances = kwargs['instances'];
+
     for (a_name in program.attributes) {
         var a = program.attributes[a_name];
-        count.push(a.buffer.size / a.size);
+        // Per instance attributes don't limit the number of vertices
+        if (a.divisor) {
+            continue;
+        }
+        var available = a.buffer.bytes - a.offset_bytes;
+        count.push(available < a.element_bytes ? 0 : Math.floor((available - a.element_bytes) / a.stride_bytes) + 1);
     }
     count = Math.trunc(Math.min(...count));
 
@@ -340,8 +620,32 @@ var api_display_execute_program = function (state, args, kwargs) {
     //     state.gl.bufferData(state.gl.ARRAY_BUFFER, new Float32Array(val), state.gl.STATIC_DRAW);
     // }
 
-    // Draw
-    state.gl.drawArrays(draw_type, 0, count);
+    // Draw, timed on the GPU when gpu timing is on
+    var query = util_gpu_begin(state);
+    if (kwargs['index_buffer'] != null) {
+        var index_buffer = state.index_buffers[kwargs['index_buffer']];
+        var first = kwargs['first'] || 0;
+        var index_count = (kwargs['count'] != null) ? kwargs['count'] : index_buffer.size - first;
+        var offset = first * index_buffer.bytes_per_index;
+
+        // Binding the element buffer while the vertex array is bound stores it in the vertex array
+        state.gl.bindBuffer(state.gl.ELEMENT_ARRAY_BUFFER, index_buffer.buff);
+        if (instances != null) {
+            state.gl.drawElementsInstanced(draw_type, index_count, index_buffer.type, offset, instances);
+        }
+        else
+        {
+            state.gl.drawElements(draw_type, index_count, index_buffer.type, offset);
+        }
+    }
+    else if (instances != null) {
+        state.gl.drawArraysInstanced(draw_type, 0, count, instances);
+    }
+    else
+    {
+        state.gl.drawArrays(draw_type, 0, count);
+    }
+    util_gpu_end(state, query, {kind: "draw", program: program_index, frame: state.frame_number + 1});
 
     return {type: "display", response: {
         func: "execute_program",
@@ -379,7 +683,9 @@ var api_display_set_gl_clear_color = function (state, args, kwargs) {
 
 var api_display_clear = function (state, args, kwargs) {
 
+    var query = util_gpu_begin(state);
     state.gl.clear(state.gl.COLOR_BUFFER_BIT | state.gl.DEPTH_BUFFER_BIT);
+    util_gpu_end(state, query, {kind: "clear", frame: state.frame_number + 1});
 
     return {type: "display", response: {
         func: "clear",
@@ -397,14 +703,27 @@ var api_display_init_display = function (state, args, kwargs) {
     state.programs = [];
     state.array_buffers = {};
     state.new_buff_id = 0;
-
-    state.output_canvas = window.document.getElementById("canvas_output_ctx");
-    state.render_canvas = window.document.createElement("canvas");
-    state.render_canvas.width = 600;
-    state.render_canvas.height = 400;
-    // window.document.body.appendChild(state.render_canvas);
-
-    state.gl = state.render_canvas.getContext("webgl2", {preserveDrawingBuffer: true});
+    state.index_buffers = {};
+    state.new_index_buff_id = 0;
+    state.bundles = {};
+    state.new_bundle_id = 0;
+
+    if (state.offscreen_canvas) {
+        // Running in a worker, render straight into the page's canvas
+        state.output_canvas = null;
+        state.render_canvas = state.offscreen_canvas;
+        state.gl = state.render_canvas.getContext("webgl2", {antialias: false});
+    }
+    else
+    {
+        state.output_canvas = window.document.getElementById("canvas_output_ctx");
+        state.render_canvas = window.document.createElement("canvas");
+        state.render_canvas.width = 600;
+        state.render_canvas.height = 400;
+        // window.document.body.appendChild(state.render_canvas);
+
+        state.gl = state.render_canvas.getContext("webgl2", {preserveDrawingBuffer: true});
+    }
     if (!state.gl) {
         return {type: "display", response: {
             func: "init_display",
@@ -414,6 +733,29 @@ var api_display_init_display = function (state, args, kwargs) {
         }};
     }
 
+    if (state.offscreen_canvas) {
+        util_create_render_target(state);
+    }
+
+    state.parallel_compile = state.gl.getExtension("KHR_parallel_shader_compile");
+    state.compiling = false;
+
+    state.timer_query = state.gl.getExtension("EXT_disjoint_timer_query_webgl2");
+    state.gpu_timing = false;
+    state.gpu_queries = [];
+    state.gpu_frame = null;
+    state.gpu_timings = [];
+    state.gpu_dropped = 0;
+    state.gpu_disjoint = 0;
+
+    state.frame_pending = false;
+    state.frame_number = 0;
+    state.vsync_waiters = state.vsync_waiters || [];
+    if (!state.presenting) {
+        state.presenting = true;
+        requestAnimationFrame(function (t) { util_present_loop(state, t); });
+    }
+
     return {type: "display", response: {
         func: "init_display",
         status: 0,
@@ -442,12 +784,174 @@ var api_display_get_resolution = function (state, args, kwargs) {
     }};
 }
 
-var api_display_update_canvas = function (state, args, kwargs) {
-    console.log("Updating output canvas from render canvas...");
+var util_create_render_target = function (state) {
+    // Frames are drawn into a framebuffer and only blitted to the canvas when
+    // presented. The canvas' own buffer isn't preserved, so drawing into it
+    // directly could hand the compositor a half finished frame.
+    if (state.framebuffer) {
+        return;
+    }
+
+    var gl = state.gl;
+    var width = state.render_canvas.width;
+    var height = state.render_canvas.height;
+    var samples = Math.min(4, gl.getParameter(gl.MAX_SAMPLES));
+
+    var color = gl.createRenderbuffer();
+    gl.bindRenderbuffer(gl.RENDERBUFFER, color);
+    gl.renderbufferStorageMultisample(gl.RENDERBUFFER, samples, gl.RGBA8, width, height);
+    var depth = gl.createRenderbuffer();
+    gl.bindRenderbuffer(gl.RENDERBUFFER, depth);
+    gl.renderbufferStorageMultisample(gl.RENDERBUFFER, samples, gl.DEPTH_COMPONENT24, width, height);
+
+    state.framebuffer = gl.createFramebuffer();
+    gl.bindFramebuffer(gl.FRAMEBUFFER, state.framebuffer);
+    gl.framebufferRenderbuffer(gl.FRAMEBUFFER, gl.COLOR_ATTACHMENT0, gl.RENDERBUFFER, color);
+    gl.framebufferRenderbuffer(gl.FRAMEBUFFER, gl.DEPTH_ATTACHMENT, gl.RENDERBUFFER, depth);
+};
+
+var util_present = function (state) {
+    // Ends the frame's GPU timings, on the page the copy is done by the 2d
+    // context so the query is empty
+    var query = util_gpu_begin(state);
+    if (state.framebuffer) {
+        // Copy (and resolve) the finished frame into the canvas on the GPU,
+        // the browser picks it up once the current task ends
+        var gl = state.gl;
+        var width = state.render_canvas.width;
+        var height = state.render_canvas.height;
+        gl.bindFramebuffer(gl.READ_FRAMEBUFFER, state.framebuffer);
+        gl.bindFramebuffer(gl.DRAW_FRAMEBUFFER, null);
+        gl.blitFramebuffer(0, 0, width, height, 0, 0, width, height, gl.COLOR_BUFFER_BIT, gl.NEAREST);
+        gl.bindFramebuffer(gl.FRAMEBUFFER, state.framebuffer);
+    }
+    else
+    {
+        var destCtx = state.output_canvas.getContext('2d');
+        destCtx.clearRect(0,0,state.output_canvas.width,state.output_canvas.height);
+        destCtx.drawImage(state.render_canvas, 0, 0);
+    }
+    util_gpu_end(state, query, {kind: "present", frame: state.frame_number + 1});
+    state.frame_number += 1;
+};
+
+// Completed GPU timings are kept until gpu_timings collects them, the oldest
+// are dropped past this
+var GPU_TIMINGS_MAX = 10000;
+
+var util_gpu_begin = function (state) {
+    // Queries can't be nested, so only single commands are wrapped and a
+    // frame's time is the sum of the queries tagged with it
+    if (!state.gpu_timing) {
+        return null;
+    }
+    var query = state.gl.createQuery();
+    state.gl.beginQuery(state.timer_query.TIME_ELAPSED_EXT, query);
+    return query;
+};
+
+var util_gpu_end = function (state, query, timing) {
+    if (query == null) {
+        return;
+    }
+    state.gl.endQuery(state.timer_query.TIME_ELAPSED_EXT);
+    timing.query = query;
+    state.gpu_queries.push(timing);
+};
+
+var util_gpu_record = function (state, timing) {
+    state.gpu_timings.push(timing);
+    if (state.gpu_timings.length > GPU_TIMINGS_MAX) {
+        state.gpu_timings.shift();
+        state.gpu_dropped += 1;
+    }
+};
+
+var util_gpu_collect = function (state) {
+    // Results become available in order a few frames later, they're only
+    // read once they are so the pipeline never waits on the GPU
+    var gl = state.gl;
+    var done = 0;
+    while (done < state.gpu_queries.length && gl.getQueryParameter(state.gpu_queries[done].query, gl.QUERY_RESULT_AVAILABLE)) {
+        done += 1;
+    }
+    if (done == 0) {
+        return;
+    }
+
+    var completed = state.gpu_queries.splice(0, done);
+    // Something (e.g. a power state change) made the timer unreliable, every
+    // query in flight is thrown away
+    var disjoint = gl.getParameter(state.timer_query.GPU_DISJOINT_EXT);
+    if (disjoint) {
+        state.gpu_disjoint += 1;
+        state.gpu_frame = null;
+    }
+
+    for (var i = 0; i < completed.length; i++) {
+        var timing = completed[i];
+        var gpu_ms = disjoint ? 0 : gl.getQueryParameter(timing.query, gl.QUERY_RESULT) / 1e6;
+        gl.deleteQuery(timing.query);
+        if (disjoint) {
+            continue;
+        }
+
+        if (state.gpu_frame == null || state.gpu_frame.frame != timing.frame) {
+            state.gpu_frame = {kind: "frame", frame: timing.frame, gpu_ms: 0, draws: 0};
+        }
+        state.gpu_frame.gpu_ms += gpu_ms;
+        if (timing.kind == "draw") {
+            state.gpu_frame.draws += 1;
+            util_gpu_record(state, {kind: "draw", program: timing.program, frame: timing.frame, gpu_ms: gpu_ms});
+        }
+        else if (timing.kind == "present") {
+            util_gpu_record(state, state.gpu_frame);
+            state.gpu_frame = null;
+        }
+    }
+};
 
-    var destCtx = state.output_canvas.getContext('2d');
-    destCtx.clearRect(0,0,state.output_canvas.width,state.output_canvas.height);
-    destCtx.drawImage(state.render_canvas, 0, 0);
+var util_present_loop = function (state, timestamp) {
+    if (state.gpu_queries.length > 0) {
+        util_gpu_collect(state);
+    }
+
+    // Submitted frames are presented here, in step with the display refresh
+    if (state.frame_pending) {
+        util_present(state);
+        state.frame_pending = false;
+    }
+
+    // Run whatever was queued behind the frame, which may be the producer
+    // already asking for the next one
+    state.resume();
+
+    var waiters = state.vsync_waiters;
+    state.vsync_waiters = [];
+    for (var i = 0; i < waiters.length; i++) {
+        state.reply(waiters[i], {type: "display", response: {
+            func: "wait_for_vsync",
+            status: 0,
+            status_msg: "success",
+            data: {
+                frame: state.frame_number,
+                timestamp: (performance.timeOrigin + timestamp) / 1000.0
+            }
+        }});
+    }
+
+    requestAnimationFrame(function (t) { util_present_loop(state, t); });
+};
+
+var api_display_update_canvas = function (state, args, kwargs) {
+    if (kwargs['vsync'] === false) {
+        // Present straight away instead of waiting for the next refresh
+        util_present(state);
+    }
+    else
+    {
+        state.frame_pending = true;
+    }
 
     return {type: "display", response: {
         func: "update_canvas",
@@ -457,7 +961,308 @@ var api_display_update_canvas = function (state, args, kwargs) {
     }};
 }
 
+var api_display_wait_for_vsync = function (state, args, kwargs) {
+    if (!state.presenting) {
+        return {type: "display", response: {
+            func: "wait_for_vsync",
+            status: 1,
+            status_msg: "the display has not been initialised",
+            data: {}
+        }};
+    }
+
+    // Answered from the present loop at the next animation frame
+    state.vsync_waiters.push(state.request_id);
+    return null;
+}
+
+var api_display_set_gpu_timing = function (state, args, kwargs) {
+    const [enabled] = args;
+
+    if (enabled && !state.timer_query) {
+        return {type: "display", response: {
+            func: "set_gpu_timing",
+            status: 1,
+            status_msg: "GPU timing needs EXT_disjoint_timer_query_webgl2, which isn't available",
+            data: {}
+        }};
+    }
+    state.gpu_timing = enabled;
+
+    return {type: "display", response: {
+        func: "set_gpu_timing",
+        status: 0,
+        status_msg: "success",
+        data: {}
+    }};
+}
+
+var api_display_gpu_timings = function (state, args, kwargs) {
+    // Hands over (and forgets) the timings completed so far, with how many
+    // were dropped or lost to disjoint operations since the last call
+    var data = {
+        timings: state.gpu_timings || [],
+        dropped: state.gpu_dropped || 0,
+        disjoint: state.gpu_disjoint || 0
+    };
+    state.gpu_timings = [];
+    state.gpu_dropped = 0;
+    state.gpu_disjoint = 0;
+
+    return {type: "display", response: {
+        func: "gpu_timings",
+        status: 0,
+        status_msg: "success",
+        data: data
+    }};
+}
+
+var api_display_batch = function (state, args, kwargs) {
+    var commands = args[0];
+    var responses = [];
+    var failed = 0;
+
+    // Run every command in order, a failing command doesn't stop the rest of
+    // the batch from being drawn
+    for (var i = 0; i < commands.length; i++) {
+        var r = null;
+        if (commands[i].func == "wait_for_vsync" || (commands[i].func == "compile_programs" && commands[i].kwargs.parallel !== false)) {
+            r = {type: "display", response: {
+                func: commands[i].func,
+                status: 1,
+                status_msg: commands[i].func + " can't be batched",
+                data: {}
+            }};
+            responses.push(r.response);
+            failed += 1;
+            continue;
+        }
+        try {
+            r = api_display_handle(state, commands[i]);
+        } catch (e) {
+            r = {type: "display", response: {
+                func: commands[i].func,
+                status: 1,
+                status_msg: "" + e,
+                data: {}
+            }};
+        }
+        if (r.response.status != 0) {
+            failed += 1;
+        }
+        responses.push(r.response);
+    }
+
+    return {type: "display", response: {
+        func: "batch",
+        status: (failed == 0) ? 0 : 1,
+        status_msg: (failed == 0) ? "success" : failed + " batched command(s) failed",
+        data: {
+            responses: responses
+        }
+    }};
+}
+
+var util_invalidate_bundles = function (state, resource_type, resource_id) {
+    // Bundles can't be replayed once a resource they use is gone
+    for (var bundle_id in state.bundles) {
+        if (state.bundles[bundle_id][resource_type].has(resource_id)) {
+            delete state.bundles[bundle_id];
+        }
+    }
+};
+
+var api_display_record_bundle = function (state, args, kwargs) {
+    var commands = args[0];
+    var bundle = {
+        commands: commands,
+        // Binary payloads referenced by the commands are kept with the bundle
+        binary: state.binary,
+        programs: new Set(),
+        array_buffers: new Set(),
+        index_buffers: new Set()
+    };
+
+    for (var i = 0; i < commands.length; i++) {
+        var cmd = commands[i];
+        switch (cmd.func) {
+            case "program_update_uniforms":
+            case "program_link_attributes":
+                bundle.programs.add(cmd.args[0]);
+                if (cmd.func == "program_link_attributes") {
+                    for (var a_name in cmd.args[1]) {
+                        // A link is a buffer id or a layout naming the buffer
+                        var link = cmd.args[1][a_name];
+                        bundle.array_buffers.add(typeof link === "object" ? link.buffer : link);
+                    }
+                }
+                break;
+            case "execute_program":
+                bundle.programs.add(cmd.args[0]);
+                if (cmd.kwargs['index_buffer'] != null) {
+                    bundle.index_buffers.add(cmd.kwargs['index_buffer']);
+                }
+                break;
+            case "buffer_update_data":
+            case "buffer_update_sub_data":
+                bundle.array_buffers.add(cmd.args[0]);
+                break;
+            case "index_buffer_update_data":
+                bundle.index_buffers.add(cmd.args[0]);
+                break;
+            case "batch":
+            case "record_bundle":
+            case "play_bundle":
+            case "wait_for_vsync":
+            case "compile_programs":
+                return {type: "display", response: {
+                    func: "record_bundle",
+                    status: 1,
+                    status_msg: "bundles can't contain " + cmd.func + " commands",
+                    data: {}
+                }};
+        }
+    }
+
+    var bundle_id = util_resource_id(kwargs, state.new_bundle_id);
+    state.new_bundle_id = Math.max(state.new_bundle_id, bundle_id + 1);
+    state.bundles[bundle_id] = bundle;
+
+    return {type: "display", response: {
+        func: "record_bundle",
+        status: 0,
+        status_msg: "success",
+        data: {
+            id: bundle_id
+        }
+    }};
+};
+
+var api_display_play_bundle = function (state, args, kwargs) {
+    var bundle = state.bundles[args[0]];
+    var overrides = kwargs['overrides'] || {};
+    var failed = 0;
+
+    if (bundle === undefined) {
+        return {type: "display", response: {
+            func: "play_bundle",
+            status: 1,
+            status_msg: "unknown bundle (" + args[0] + "), it may have been invalidated by a deleted resource",
+            data: {}
+        }};
+    }
+
+    var message_binary = state.binary;
+    state.binary = bundle.binary;
+    for (var i = 0; i < bundle.commands.length; i++) {
+        var cmd = bundle.commands[i];
+        if (cmd.func == "program_update_uniforms") {
+            // Patch in any overridden values for uniforms this command sets
+            var uniform_values = Object.assign({}, cmd.args[1]);
+            for (var u_name in overrides) {
+                if (u_name in uniform_values) {
+                    uniform_values[u_name] = overrides[u_name];
+                }
+            }
+            cmd = {func: cmd.func, args: [cmd.args[0], uniform_values], kwargs: cmd.kwargs};
+        }
+        if (api_display_handle(state, cmd).response.status != 0) {
+            failed += 1;
+        }
+    }
+    state.binary = message_binary;
+
+    return {type: "display", response: {
+        func: "play_bundle",
+        status: (failed == 0) ? 0 : 1,
+        status_msg: (failed == 0) ? "success" : failed + " bundled command(s) failed",
+        data: {}
+    }};
+};
+
+var api_display_delete_bundle = function (state, args, kwargs) {
+    delete state.bundles[args[0]];
+
+    return {type: "display", response: {
+        func: "delete_bundle",
+        status: 0,
+        status_msg: "success",
+        data: {}
+    }};
+};
+
+var api_display_delete_buffer = function (state, args, kwargs) {
+    var buff_index = args[0];
+    var buff = state.array_buffers[buff_index];
+
+    if (buff !== undefined) {
+        state.gl.deleteBuffer(buff.buff);
+        delete state.array_buffers[buff_index];
+    }
+    util_invalidate_bundles(state, "array_buffers", buff_index);
+
+    return {type: "display", response: {
+        func: "delete_buffer",
+        status: 0,
+        status_msg: "success",
+        data: {}
+    }};
+};
+
+var api_display_delete_index_buffer = function (state, args, kwargs) {
+    var buff_index = args[0];
+    var buff = state.index_buffers[buff_index];
+
+    if (buff !== undefined) {
+        state.gl.deleteBuffer(buff.buff);
+        delete state.index_buffers[buff_index];
+    }
+    util_invalidate_bundles(state, "index_buffers", buff_index);
+
+    return {type: "display", response: {
+        func: "delete_index_buffer",
+        status: 0,
+        status_msg: "success",
+        data: {}
+    }};
+};
+
+var api_display_delete_program = function (state, args, kwargs) {
+    var program_index = args[0];
+    var program = state.programs[program_index];
+
+    if (program !== undefined) {
+        state.gl.deleteVertexArray(program.vao);
+        state.gl.deleteProgram(program.glid);
+        delete state.programs[program_index];
+    }
+    util_invalidate_bundles(state, "programs", program_index);
+
+    return {type: "display", response: {
+        func: "delete_program",
+        status: 0,
+        status_msg: "success",
+        data: {}
+    }};
+};
+
+var util_trace_time = function (now) {
+    // Seconds since the epoch, the clock the connector and Display trace with
+    return (performance.timeOrigin + now) / 1000.0;
+};
+
 var api_display_handle = function (state, msg) {
+    if (!state.trace_spans) {
+        return api_display_run(state, msg);
+    }
+
+    var start = performance.now();
+    var r = api_display_run(state, msg);
+    state.trace_spans.push({func: msg.func, start: util_trace_time(start), end: util_trace_time(performance.now())});
+    return r;
+};
+
+var api_display_run = function (state, msg) {
     // console.log("Display API msg RECV: " + msg.func);
     var r = null;
     switch (msg.func) {
@@ -476,12 +1281,24 @@ var api_display_handle = function (state, msg) {
         case "create_program":
             r = api_display_create_program(state, msg.args, msg.kwargs);
             return r;
+        case "compile_programs":
+            r = api_display_compile_programs(state, msg.args, msg.kwargs);
+            return r;
         case "create_buffer":
             r = api_display_create_buffer(state, msg.args, msg.kwargs);
             return r;
         case "buffer_update_data":
             r = api_display_buffer_update_data(state, msg.args, msg.kwargs);
             return r;
+        case "buffer_update_sub_data":
+            r = api_display_buffer_update_sub_data(state, msg.args, msg.kwargs);
+            return r;
+        case "create_index_buffer":
+            r = api_display_create_index_buffer(state, msg.args, msg.kwargs);
+            return r;
+        case "index_buffer_update_data":
+            r = api_display_index_buffer_update_data(state, msg.args, msg.kwargs);
+            return r;
         case "program_link_attributes":
             r = api_display_program_link_attributes(state, msg.args, msg.kwargs);
             return r;
@@ -503,6 +1320,36 @@ var api_display_handle = function (state, msg) {
         case "update_canvas":
             r = api_display_update_canvas(state, msg.args, msg.kwargs);
             return r;
+        case "wait_for_vsync":
+            r = api_display_wait_for_vsync(state, msg.args, msg.kwargs);
+            return r;
+        case "set_gpu_timing":
+            r = api_display_set_gpu_timing(state, msg.args, msg.kwargs);
+            return r;
+        case "gpu_timings":
+            r = api_display_gpu_timings(state, msg.args, msg.kwargs);
+            return r;
+        case "batch":
+            r = api_display_batch(state, msg.args, msg.kwargs);
+            return r;
+        case "record_bundle":
+            r = api_display_record_bundle(state, msg.args, msg.kwargs);
+            return r;
+        case "play_bundle":
+            r = api_display_play_bundle(state, msg.args, msg.kwargs);
+            return r;
+        case "delete_bundle":
+            r = api_display_delete_bundle(state, msg.args, msg.kwargs);
+            return r;
+        case "delete_buffer":
+            r = api_display_delete_buffer(state, msg.args, msg.kwargs);
+            return r;
+        case "delete_index_buffer":
+            r = api_display_delete_index_buffer(state, msg.args, msg.kwargs);
+            return r;
+        case "delete_program":
+            r = api_display_delete_program(state, msg.args, msg.kwargs);
+            return r;
         default:
             return {type: "display", response: {
                 func: msg.func,
@@ -0,0 +1,21 @@
+// Copyright 2020 Mathew Young
+
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+
+//     http://www.apache.org/licenses/LICENSE-2.0
+
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+// Runs the connector and the display firmware off the page's main thread,
+// the page transfers its canvas here as an OffscreenCanvas
+importScripts("connector_config", "display_firmware", "connector");
+
+onmessage = function (event) {
+    setup_connector(event.data.session, event.data.hostname, event.data.canvas);
+};
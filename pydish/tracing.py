@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Mathew Young
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+# Chrome trace events need numeric process ids, one per place a command passes through
+TRACE_PROCESSES = (
+    (1, "app"),
+    (2, "connector"),
+    (3, "device")
+)
+
+# (name, process, start point, end point) of the spans recorded for each command
+TRACE_STAGES = (
+    ("app to connector", 1, "enqueue", "dequeue"),
+    ("connector queue", 2, "dequeue", "send"),
+    ("to device", 3, "send", "receive"),
+    ("firmware", 3, "receive", "handled"),
+    ("reply to connector", 2, "handled", "reply"),
+    ("reply to app", 1, "reply", "done")
+)
+
+def _us(seconds):
+    return int(seconds * 1000000)
+
+class Tracer(object):
+    # Collects the timestamps a traced command picks up on its way through
+    # the Display (enqueue), the connector (dequeue, send), the firmware
+    # (receive, per command handler spans, handled) and back (reply, done),
+    # all in seconds since the epoch, and writes them as Chrome trace events
+    # that Perfetto or chrome://tracing can open
+    def __init__(self, max_commands=100000):
+        self.max_commands = max_commands
+        self.commands = []
+
+    def record(self, session, request_id, func, trace, done):
+        if len(self.commands) < self.max_commands:
+            trace = dict(trace)
+            trace['done'] = done
+            self.commands.append((session, request_id, func, trace))
+
+    def events(self):
+        events = []
+        for pid, name in TRACE_PROCESSES:
+            events.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": name}})
+
+        # Thread ids have to be numbers too, each gets named after its session
+        tids = {}
+        def tid(pid, name):
+            if (pid, name) not in tids:
+                tids[(pid, name)] = len(tids) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tids[(pid, name)], "args": {"name": name}})
+            return tids[(pid, name)]
+
+        for session, request_id, func, trace in self.commands:
+            args = {"id": request_id, "session": session}
+            events.append({
+                "name": func, "cat": "command", "ph": "X", "pid": 1, "tid": tid(1, session),
+                "ts": _us(trace['enqueue']), "dur": _us(trace['done'] - trace['enqueue']), "args": args
+            })
+            for name, pid, start, end in TRACE_STAGES:
+                if start in trace and end in trace:
+                    events.append({
+                        "name": name, "cat": "stage", "ph": "X", "pid": pid, "tid": tid(pid, session),
+                        "ts": _us(trace[start]), "dur": _us(max(0, trace[end] - trace[start])),
+                        "args": dict(args, func=func)
+                    })
+            # Time spent in api_display_handle, one span per command in a batch
+            for span in trace.get('spans', ()):
+                events.append({
+                    "name": span['func'], "cat": "firmware", "ph": "X", "pid": 3, "tid": tid(3, "%s handlers" % session),
+                    "ts": _us(span['start']), "dur": _us(max(0, span['end'] - span['start'])), "args": args
+                })
+        return events
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": self.events(), "displayTimeUnit": "ms"}, f)